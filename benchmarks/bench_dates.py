@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import itertools
+import os
+import sys
+import time
+
+import parsedatetime as pdt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'symbols'))
+
+import bench_keystats  # noqa
+import dates  # noqa
+import fetch  # noqa
+
+
+# get_date as it was before the dates module, kept to measure against
+def legacy_get_date(s):
+    if not isinstance(s, basestring):
+        return s
+    time_tpl = pdt.Calendar().parse(s)[0][:7]
+    return datetime.datetime(*time_tpl)
+
+
+def load_tickers(count):
+    pages = bench_keystats.load_pages()
+    stats = [bench_keystats.parse(text) for name, text in pages]
+    return [{'ticker': 'T%s' % i, 'ticker_id': i, 'keystats': s}
+            for i, s in itertools.izip(xrange(count), itertools.cycle(stats))]
+
+
+def make_handler():
+    handler = fetch.KeystatsHandler(None, 'fundamentals',
+                                    batch_size=float('inf'),
+                                    flush_interval=float('inf'))
+    handler.ticker_ids = {}
+    handler.buffer = []
+    handler.last_flush = time.time()
+    return handler
+
+
+def time_handler(tickers, get_date):
+    saved, fetch.get_date = fetch.get_date, get_date
+    handler = make_handler()
+    try:
+        start = time.time()
+        for ticker in tickers:
+            handler.message_handler(ticker)
+        return (time.time() - start) / len(tickers)
+    finally:
+        fetch.get_date = saved
+
+
+def run(count=2000):
+    tickers = load_tickers(count)
+
+    for ticker in tickers[:len(bench_keystats.load_pages())]:
+        for k, v in ticker['keystats'].iteritems():
+            if fetch.KEY_MAP.get(k) not in fetch.DATE_MAP:
+                continue
+            legacy, fast = legacy_get_date(v), dates.get_date(v)
+            # The old path carried the current time of day along
+            if isinstance(legacy, datetime.datetime):
+                legacy = legacy.replace(hour=0, minute=0, second=0,
+                                        microsecond=0)
+            if legacy != fast:
+                raise AssertionError('%r: %r != %r' % (v, legacy, fast))
+
+    # A fresh parser so the timing includes filling the cache
+    dates.PARSER = dates.DateParser()
+
+    return {'legacy': time_handler(tickers, legacy_get_date),
+            'cached': time_handler(tickers, dates.get_date)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark keystats date '
+                                                 'conversion per ticker')
+    parser.add_argument('-n', '--number',
+                        default=2000,
+                        type=int,
+                        help='Number of tickers to push through the handler')
+    args = parser.parse_args()
+
+    results = run(args.number)
+    for case in ('legacy', 'cached'):
+        print('%-8s %8.3f ms/ticker' % (case, results[case] * 1000))
+    print('saving   %8.3f ms/ticker' %
+          ((results['legacy'] - results['cached']) * 1000))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import os
+import sys
+import timeit
+
+from lxml import etree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures', 'keystats')
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'symbols'))
+
+import fetch  # noqa
+import keystats  # noqa
+
+
+def load_pages(directory=FIXTURES):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append((os.path.basename(path), f.read()))
+    return pages
+
+
+# The parser as it was before KeystatsParser, kept to measure against
+def legacy_parse(text):
+    tree = etree.HTML(text)
+    stats = {}
+
+    xpath = ('//table[@class="yfnc_datamodoutline1"]/tr/td/table/tr'
+             '/td[@class="yfnc_tabledata1" or @class="yfnc_tablehead1"]')
+
+    for name, value in keystats.pairwise(tree.xpath(xpath)):
+        if len(value) > 0:
+            value = value.xpath('.//span')[0]
+
+        name = keystats.normalize_label(name.text)
+        stats[name] = fetch.numify(value.text.strip())
+
+    return stats
+
+
+def parse(text, parser=fetch.KEYSTATS_PARSER):
+    return dict((name, fetch.numify(value))
+                for name, value in parser.parse(text))
+
+
+CASES = (('legacy', legacy_parse),
+         ('parse', parse))
+
+
+def run(pages, number=20, repeat=3):
+    for name, text in pages:
+        expected = legacy_parse(text)
+        for case, func in CASES:
+            if func(text) != expected:
+                raise AssertionError('%s disagrees on %s' % (case, name))
+
+    results = {}
+    for case, func in CASES:
+        timer = timeit.Timer(lambda: [func(text) for name, text in pages])
+        best = min(timer.repeat(repeat=repeat, number=number))
+        results[case] = best / (number * len(pages))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark keystats parsing')
+    parser.add_argument('-d', '--directory',
+                        default=FIXTURES,
+                        help='Directory of saved keystats pages')
+    parser.add_argument('-n', '--number',
+                        default=20,
+                        type=int,
+                        help='Passes over the corpus per timing')
+    parser.add_argument('-r', '--repeat',
+                        default=3,
+                        type=int,
+                        help='Timings to take the best of')
+    args = parser.parse_args()
+
+    pages = load_pages(args.directory)
+    if not pages:
+        parser.error('No pages found in %s' % args.directory)
+
+    results = run(pages, args.number, args.repeat)
+    for case, func in CASES:
+        print('%-14s %8.3f ms/page' % (case, results[case] * 1000))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'symbols'))
+
+import columnar  # noqa
+import fetch  # noqa
+
+
+# Values shaped like a crawl dump: two decimals, bounded ranges, lots of N/A
+def crawl_value(rnd):
+    kind = rnd.random()
+
+    if kind < 0.15:
+        return 'N/A'
+    if kind < 0.45:
+        return '%.2f%%' % rnd.uniform(-100, 100)
+    if kind < 0.7:
+        return '%.2f%s' % (rnd.uniform(1, 999), rnd.choice('BMK'))
+    if kind < 0.8:
+        return '{:,}'.format(rnd.randint(0, 10 ** 7))
+    return '%.2f' % rnd.uniform(0, 500)
+
+
+def run(number=1000000, seed=0):
+    rnd = random.Random(seed)
+    values = [crawl_value(rnd) for i in xrange(number)]
+    array = np.array(values, dtype=object)
+
+    def scalar():
+        for value in values:
+            try:
+                fetch.numify(value)
+            except ValueError:
+                pass
+
+    results = {}
+    for case, func in (('scalar', scalar),
+                       ('column', lambda: columnar.numify_column(array))):
+        start = time.time()
+        func()
+        results[case] = (time.time() - start) / number
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the columnar '
+                                                 'numify')
+    parser.add_argument('-n', '--number',
+                        default=1000000,
+                        type=int,
+                        help='Values to convert in the timing run')
+    args = parser.parse_args()
+
+    results = run(args.number)
+    for case in ('scalar', 'column'):
+        print('%-8s %8.3f us/value' % (case, results[case] * 1000000))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
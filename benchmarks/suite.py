@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'symbols'))
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'magicformula'))
+
+import bench_numify  # noqa
+import columnar  # noqa
+import fetch  # noqa
+import pagecache  # noqa
+import predictng  # noqa
+import ranking  # noqa
+
+SIZES = (1000, 10000, 100000, 1000000)
+THRESHOLD = 0.25
+MIN_TIME = 0.2
+REPEAT = 3
+
+SECTORS = ('Technology', 'Healthcare', 'Services', 'Consumer Goods',
+           'Industrial Goods') + predictng.EXCLUDED_SECTORS
+INDUSTRIES = ('Personal Computers', 'Drug Manufacturers - Major',
+              'Aerospace/Defense - Major Diversified',
+              'Beverages - Soft Drinks') + predictng.EXCLUDED_INDUSTRIES
+DESCRIPTIONS = ('Widgets Inc', 'Acme Corp', 'Globex Holdings',
+                'First Bancorp', 'Energy Partners LP', 'Siemens AG ADS',
+                'Total S.A.', 'Initech Investment Trust')
+
+
+# Serves the saved pages under fixtures/ for any url whose file name matches,
+# the way requests would
+class FixtureSession(object):
+    def __init__(self, directory=FIXTURES):
+        self.pages = {}
+        for path in glob.glob(os.path.join(directory, '*', '*.html')):
+            with open(path, 'rb') as f:
+                self.pages[os.path.basename(path)] = f.read()
+
+    def get(self, url, **kwargs):
+        name = url.rsplit('/', 1)[-1]
+        if name.startswith('ks?s='):
+            name = name[len('ks?s='):] + '.html'
+        return pagecache.CachedResponse(url, self.pages[name])
+
+    def close(self):
+        pass
+
+
+def synthetic_fundamentals(size, seed=0):
+    rs = np.random.RandomState(seed)
+    df = pd.DataFrame({'market_cap': np.exp(rs.uniform(13, 27, size)),
+                       'pt_b': rs.uniform(0.1, 8, size),
+                       'ebitda': rs.normal(5e7, 2e8, size),
+                       'pe': np.round(rs.uniform(-10, 60, size), 2),
+                       'yield': np.round(rs.uniform(0, 15, size), 2),
+                       'sector': rs.choice(SECTORS, size),
+                       'industry': rs.choice(INDUSTRIES, size),
+                       'description': rs.choice(DESCRIPTIONS, size)},
+                      index=['S%07d' % i for i in xrange(size)])
+    df.loc[rs.uniform(size=size) < 0.05, 'pe'] = np.nan
+    return df
+
+
+def measure(func, min_time=MIN_TIME, repeat=REPEAT):
+    # Best of repeat, each timing enough calls to last min_time
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for i in xrange(repeat - 1):
+        start = time.time()
+        for i in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return best / number
+
+
+def scrape_cases(session):
+    rnd = random.Random(0)
+    values = [bench_numify.crawl_value(rnd) for i in xrange(10000)]
+    column = np.array(values, dtype=object)
+
+    def numify():
+        for value in values:
+            fetch.numify(value)
+
+    keystats = sorted(os.path.basename(path)[:-len('.html')]
+                      for path in glob.glob(os.path.join(FIXTURES, 'keystats',
+                                                         '*.html')))
+    industry_ids = fetch.get_industry_ids(session)
+
+    yield 'numify', 'value', len(values), numify
+    yield ('numify_column', 'value', len(values),
+           lambda: columnar.numify_column(column))
+    yield ('get_industry_ids', 'page', 1,
+           lambda: fetch.get_industry_ids(session))
+    yield ('get_tickers_for_industry', 'page', len(industry_ids),
+           lambda: [fetch.get_tickers_for_industry(i, session)
+                    for i in industry_ids])
+    yield ('get_keystats', 'page', len(keystats),
+           lambda: [fetch.get_keystats({'ticker': t}, session)
+                    for t in keystats])
+
+
+def frame_cases(sizes):
+    for size in sizes:
+        df = synthetic_fundamentals(size)
+        # Ranked unscreened, the screen leaves too few rows to time
+        # ranking at this size
+        full = predictng.add_roc(df.copy())
+
+        yield ('get_stocks/%d' % size, 'frame', 1,
+               lambda df=df: predictng.SCREEN.apply(
+                   predictng.add_roc(df.copy())))
+        for order in (ranking.LEXICOGRAPHIC, ranking.COMBINED):
+            yield ('rank_stocks/%s/%d' % (order, size), 'frame', 1,
+                   lambda order=order: predictng.rank_stocks(full, 15,
+                                                             order))
+
+
+def run(sizes=SIZES, min_time=MIN_TIME, repeat=REPEAT, only=None):
+    session = FixtureSession()
+    cases = itertools.chain(scrape_cases(session), frame_cases(sizes))
+
+    results = {}
+    for name, unit, count, func in cases:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        seconds = measure(func, min_time, repeat) / count
+        results[name] = {'seconds': seconds, 'unit': unit}
+        sys.stderr.write('%-36s %12.3f us/%s\n' % (name, seconds * 1e6,
+                                                   unit))
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    # Cases slower than the baseline by more than threshold, as
+    # (name, baseline seconds, seconds)
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['seconds']
+        if result['seconds'] > before * (1 + threshold):
+            regressions.append((name, before, result['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scrape, '
+                                                 'parse, screen and rank '
+                                                 'hot paths offline')
+    parser.add_argument('-o', '--output',
+                        default=None,
+                        help='Write the results as json here (default: '
+                             'stdout)')
+    parser.add_argument('-b', '--baseline',
+                        default=None,
+                        help='Earlier results to compare against')
+    parser.add_argument('-t', '--threshold',
+                        default=THRESHOLD,
+                        type=float,
+                        help='Fraction slower than the baseline that counts '
+                             'as a regression')
+    parser.add_argument('-s', '--sizes',
+                        default=','.join(str(s) for s in SIZES),
+                        help='Comma separated fundamentals frame sizes')
+    parser.add_argument('-m', '--min-time',
+                        default=MIN_TIME,
+                        type=float,
+                        help='Seconds each timing runs for at least')
+    parser.add_argument('-r', '--repeat',
+                        default=REPEAT,
+                        type=int,
+                        help='Timings to take the best of')
+    parser.add_argument('cases',
+                        nargs='*',
+                        help='Only run cases starting with these names')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+    results = run(sizes, args.min_time, args.repeat, args.cases)
+
+    report = {'python': platform.python_version(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'machine': platform.machine(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print('')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            sys.stderr.write('REGRESSION %s: %.3f us -> %.3f us (%+.0f%%)\n' %
+                             (name, before * 1e6, after * 1e6,
+                              (after / before - 1) * 100))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
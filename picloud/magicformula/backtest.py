@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import multiprocessing
+import sys
+
+import MySQLdb
+import numpy as np
+import pandas as pd
+
+import predict
+import predictng
+import ranking
+import snapshots
+
+
+FREQ = 'W-FRI'
+MAX_AGE = datetime.timedelta(days=7)
+CHUNK_SIZE = 52
+
+# The panel being screened, set before the pool forks so workers only get
+# row bounds instead of a pickled copy of their chunk
+_PANEL = None
+
+
+def load_history(db_kwargs, start, end, table='fundamentals'):
+    qry = """
+    SELECT t.ticker, t.sector, t.industry, f.*
+    FROM %s f, tickers t
+    WHERE f.ticker_id = t.id
+    AND f.refresh_dt BETWEEN %%s AND %%s
+    """ % table
+    conn = MySQLdb.connect(**db_kwargs)
+    df = pd.read_sql(qry, conn, params=[start, end])
+    conn.close()
+    return df.rename(columns={'refresh_dt': 'date'})
+
+
+def load_snapshots(store, exchanges, start=None, end=None):
+    frames = []
+    for exchange in exchanges:
+        for date in store.dates(exchange):
+            if ((start is not None and date < start) or
+                    (end is not None and date > end)):
+                continue
+            df = store.read(exchange, date, mmap=False)
+            df['ticker'] = df.index
+            df['date'] = pd.Timestamp(date)
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+# close prices as a csv of date, ticker, close
+def load_prices(path):
+    return pd.read_csv(path, parse_dates=['date'])
+
+
+def _select(args):
+    screen, ranks, num, order, start, stop = args
+    panel = _PANEL.iloc[start:stop]
+    panel = panel[screen.mask(panel)]
+    return ranking.rank_groups(panel, ranks, panel['period'].values, num,
+                               order)
+
+
+# Replays a screen and rank over history. Every rebalance date holds the
+# num best stocks from each ticker's latest fundamentals refreshed
+# within max_age before it, equally weighted, until the next rebalance
+# date. Screening and ranking run on the whole panel at once, date
+# chunks spread over a process pool, and returns come from one sorted
+# price lookup.
+class Backtest(object):
+    def __init__(self, screen, ranks, num_stocks=15,
+                 order=ranking.LEXICOGRAPHIC, prepare=None,
+                 max_age=MAX_AGE, processes=None, chunk_size=CHUNK_SIZE):
+        self.screen = screen
+        self.ranks = ranks
+        self.num_stocks = num_stocks
+        self.order = order
+        self.prepare = prepare
+        self.max_age = max_age
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    def periods(self, panel, dates):
+        # The latest row of every ticker refreshed within max_age before
+        # each rebalance date, (date - max_age, date], ordered by rebalance
+        # date. A row stands for every date from its own until the
+        # ticker's next row or max_age later, whichever comes first, so a
+        # row can serve several dates when they are closer than max_age
+        dates = pd.DatetimeIndex(dates).values
+        when = pd.DatetimeIndex(panel['date']).values
+        codes = pd.factorize(panel['ticker'].values)[0]
+
+        rows = np.lexsort((when, codes))
+        codes = codes[rows]
+        when = when[rows]
+
+        end = when + np.timedelta64(self.max_age)
+        same = np.flatnonzero(codes[1:] == codes[:-1])
+        end[same] = np.minimum(end[same], when[same + 1])
+
+        first = np.searchsorted(dates, when, side='left')
+        count = np.maximum(np.searchsorted(dates, end, side='left') - first,
+                           0)
+
+        total = count.sum()
+        starts = np.cumsum(count) - count
+        period = (np.arange(total) - np.repeat(starts, count) +
+                  np.repeat(first, count))
+        rows = np.repeat(rows, count)
+        codes = np.repeat(codes, count)
+
+        order = np.lexsort((codes, period))
+        panel = panel.iloc[rows[order]].copy()
+        panel['period'] = period[order]
+        return panel
+
+    def select(self, panel, dates):
+        global _PANEL
+
+        panel = self.periods(panel, dates)
+        if self.prepare is not None:
+            panel = self.prepare(panel)
+
+        bounds = np.searchsorted(panel['period'].values,
+                                 np.arange(0, len(dates) + self.chunk_size,
+                                           self.chunk_size))
+        jobs = [(self.screen, self.ranks, self.num_stocks, self.order,
+                 start, stop)
+                for start, stop in zip(bounds[:-1], bounds[1:])
+                if stop > start]
+
+        _PANEL = panel
+        try:
+            if self.processes == 1 or len(jobs) < 2:
+                results = map(_select, jobs)
+            else:
+                pool = multiprocessing.Pool(self.processes)
+                try:
+                    results = pool.map(_select, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            _PANEL = None
+
+        if not results:
+            return panel.iloc[:0]
+        return pd.concat(results)
+
+    def run(self, panel, prices, dates):
+        dates = pd.DatetimeIndex(dates)
+        holdings = self.select(panel, dates)
+
+        close = Prices(prices)
+        period = holdings['period'].values
+        tickers = holdings['ticker'].values
+        held = period + 1 < len(dates)
+
+        start = close.asof(tickers[held], dates.values[period[held]])
+        end = close.asof(tickers[held], dates.values[period[held] + 1])
+        returns = end / start - 1
+        priced = ~np.isnan(returns)
+
+        count = np.bincount(period[held][priced], minlength=len(dates))
+        total = np.bincount(period[held][priced], weights=returns[priced],
+                            minlength=len(dates))
+
+        result = pd.DataFrame({'holdings': np.bincount(period,
+                                                       minlength=len(dates)),
+                               'priced': count},
+                              index=dates)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result['return'] = np.where(count > 0, total / count, 0.0)
+        result['equity'] = (1 + result['return']).cumprod()
+        return result, holdings
+
+
+# Close prices sorted once by ticker and day, so the last close on or
+# before any (ticker, date) is a single searchsorted
+class Prices(object):
+    DAY = np.timedelta64(1, 'D')
+
+    def __init__(self, prices):
+        self.tickers = pd.Index(pd.unique(prices['ticker'].values))
+        self.origin = 0
+        days = self.days(prices['date'].values)
+        self.origin = days.min()
+        days -= self.origin
+        self.span = days.max() + 1
+
+        keys = self.tickers.get_indexer(prices['ticker'].values) * self.span
+        keys += days
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.close = prices['close'].values.astype(np.float64)[order]
+
+    def days(self, dates):
+        days = (pd.DatetimeIndex(dates).values.astype('datetime64[D]') -
+                np.datetime64('1970-01-01')) // self.DAY
+        return days - self.origin
+
+    def asof(self, tickers, dates):
+        codes = self.tickers.get_indexer(tickers)
+        days = np.minimum(self.days(dates), self.span - 1)
+        at = np.searchsorted(self.keys, codes * self.span + days,
+                             side='right') - 1
+
+        out = np.empty(len(codes), dtype=np.float64)
+        out.fill(np.nan)
+        found = (codes >= 0) & (days >= 0) & (at >= 0)
+        found[found] &= self.keys[at[found]] // self.span == codes[found]
+        out[found] = self.close[at[found]]
+        return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest the MagicFormula '
+                                                 'screen',
+                                     add_help=False)
+    parser.add_argument('prices',
+                        help='CSV of date, ticker, close')
+    parser.add_argument('--start',
+                        required=True,
+                        help='First rebalance date (YYYY-MM-DD)')
+    parser.add_argument('--end',
+                        required=True,
+                        help='Last rebalance date (YYYY-MM-DD)')
+    parser.add_argument('--freq',
+                        default=FREQ,
+                        help='Rebalance frequency as a pandas offset')
+    parser.add_argument('-n', '--num_stocks',
+                        default=15,
+                        type=int,
+                        help='Number of stocks held')
+    parser.add_argument('-o', '--order',
+                        default=ranking.LEXICOGRAPHIC,
+                        choices=(ranking.LEXICOGRAPHIC, ranking.COMBINED),
+                        help='Order by P/E then return, or by the sum of '
+                             'both ranks')
+    parser.add_argument('-j', '--processes',
+                        default=None,
+                        type=int,
+                        help='Worker processes (default: one per cpu)')
+    parser.add_argument('--snapshot-dir',
+                        default=None,
+                        help='Replay stored eoddata snapshots with the '
+                             'predictng screen instead of MySQL')
+    parser.add_argument('-e', '--exchange',
+                        action='append',
+                        dest='exchanges',
+                        help='Snapshot exchange, may be repeated')
+    parser.add_argument('-h', '--host',
+                        help='MySQL host')
+    parser.add_argument('-u', '--user',
+                        help='MySQL User')
+    parser.add_argument('-p', '--password',
+                        help='MySQL password')
+    parser.add_argument('database',
+                        nargs='?',
+                        help='Database the fundamentals are stored in')
+    parser.add_argument('--help',
+                        action='help', default=argparse.SUPPRESS,
+                        help='show this help message and exit')
+
+    args = parser.parse_args()
+
+    dates = pd.date_range(args.start, args.end, freq=args.freq)
+    first = (dates[0] - MAX_AGE).strftime(snapshots.DATE_FORMAT)
+
+    if args.snapshot_dir:
+        store = snapshots.SnapshotStore(args.snapshot_dir)
+        panel = load_snapshots(store, args.exchanges or predictng.EXCHANGES,
+                               first, args.end)
+        engine = Backtest(predictng.SCREEN, predictng.RANKS, args.num_stocks,
+                          args.order, prepare=predictng.add_roc,
+                          processes=args.processes)
+
+    else:
+        if not (args.host and args.user and args.database):
+            parser.error('MySQL host, user and database are required '
+                         'without --snapshot-dir')
+
+        db_kwargs = {'host': args.host,
+                     'user': args.user,
+                     'passwd': args.password,
+                     'db': args.database}
+        panel = load_history(db_kwargs, first, args.end)
+        engine = Backtest(predict.SCREEN, predict.RANKS, args.num_stocks,
+                          args.order, processes=args.processes)
+
+    result, holdings = engine.run(panel, load_prices(args.prices), dates)
+    result.to_csv(sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
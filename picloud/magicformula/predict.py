@@ -1,12 +1,41 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 import sys
 
-import MySQLdb
-import pandas as pd
 import twitter
 
+import ranking
+import screen
+
+# The storage backends live with the fetcher that fills them
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'symbols'))
+import storage  # noqa
+
+
+LATEST_TABLE = 'fundamentals_latest'
+# Days since the last refresh a ticker is still screened
+MAX_AGE = 7
+EXCLUDED_SECTORS = ('Financial', 'Utilities')
+EXCLUDED_INDUSTRIES = ('Independent Oil & Gas',
+                       'Major Integrated Oil & Gas',
+                       'Oil & Gas Drilling & Exploration',
+                       'Oil & Gas Equipment & Services',
+                       'Oil & Gas Pipelines',
+                       'Oil & Gas Refining & Marketing')
+THRESHOLDS = (('roa_ttm', '>=', 0.25),
+              ('trailing_pe', '>=', 5),
+              ('market_cap', '>=', 30000000))
+RANKS = (('pe_rank', 'trailing_pe', True, 'min'),
+         ('return_rank', 'roa_ttm', False, 'min'))
+
+# The same screen get_stocks runs in SQL, for frames already in memory
+SCREEN = screen.Screen(excluded_sectors=EXCLUDED_SECTORS,
+                       excluded_industries=EXCLUDED_INDUSTRIES,
+                       thresholds=THRESHOLDS)
+
 
 def publish_to_twitter(df, prefix='MF', api=None, **kwargs):
     if api is None:
@@ -21,45 +50,65 @@ def publish_to_twitter(df, prefix='MF', api=None, **kwargs):
     return api.PostUpdate(msg)
 
 
-def rank_stocks(df):
-    roa_key = 'roa_ttm'
-    pe_key = 'trailing_pe'
-    roa_rank = 'return_rank'
-    pe_rank = 'pe_rank'
+def rank_stocks(df, num_stocks=None, order=ranking.LEXICOGRAPHIC):
+    return ranking.rank_frame(df, RANKS, num_stocks, order)
+
+
+def backend(db):
+    # MySQLdb.connect kwargs, as callers used to pass, or a storage backend
+    if isinstance(db, dict):
+        return storage.MySQLStorage(**db)
+    return db
+
+
+def screen_sql(alias='f', placeholder='%s'):
+    clauses = []
+    params = []
+
+    for column, values in (('sector', EXCLUDED_SECTORS),
+                           ('industry', EXCLUDED_INDUSTRIES)):
+        marks = ', '.join([placeholder] * len(values))
+        clauses.append('%s.%s NOT IN (%s)' % (alias, column, marks))
+        params.extend(values)
+
+    for column, op, value in THRESHOLDS:
+        clauses.append('%s.%s %s %s' % (alias, column,
+                                        '=' if op == '==' else op,
+                                        placeholder))
+        params.append(value)
 
-    df[pe_rank] = df[pe_key].rank(method='min')
-    df[roa_rank] = df[roa_key].rank(method='min', ascending=0)
-    return df.sort_index(by=[pe_rank, roa_rank], ascending=[1, 1])
+    return ' AND '.join(clauses), params
 
 
-def get_stocks(db_kwargs):
+def get_latest(db, table=LATEST_TABLE):
+    # Everything refreshed in the last week, before any screen
+    store = backend(db)
     qry = """
-    SELECT t.ticker, f.*, MAX(f.refresh_dt)
-    FROM fundamentals f, tickers t
-    WHERE f.ticker_id = t.id
-    AND f.refresh_dt BETWEEN DATE_SUB(NOW(), INTERVAL 1 WEEK) AND NOW()
-    AND t.sector NOT IN ('Financial', 'Utilities')
-    AND t.industry NOT IN ('Independent Oil & Gas',
-                           'Major Integrated Oil & Gas',
-                           'Oil & Gas Drilling & Exploration'
-                           'Oil & Gas Equipment & Services',
-                           'Oil & Gas Pipelines',
-                           'Oil & Gas Refining & Marketing')
-    AND f.roa_ttm >= 0.25
-    AND f.trailing_pe >= 5
-    AND f.market_cap >= 30000000
-    GROUP BY f.ticker_id
-    """
-    conn = MySQLdb.connect(**db_kwargs)
-    df = pd.read_sql(qry, conn, index_col='ticker')
-    conn.close()
-    return df
-
-
-def predict(num_stocks, db_kwargs, twitter_kwargs):
-    stocks = get_stocks(db_kwargs)
-    rank = rank_stocks(stocks)
-    return publish_to_twitter(rank[:num_stocks].T, **twitter_kwargs)
+    SELECT f.*
+    FROM %s f
+    WHERE %s
+    """ % (table, store.recent('f.refresh_dt', MAX_AGE))
+    return store.read_frame(qry, index_col='ticker')
+
+
+def get_stocks(db, table=LATEST_TABLE):
+    # One row per ticker, maintained by the symbols fetcher, so this reads
+    # the ticker count no matter how much history has been stored
+    store = backend(db)
+    where, params = screen_sql(placeholder=store.placeholder)
+    qry = """
+    SELECT f.*
+    FROM %s f
+    WHERE %s
+    AND %s
+    """ % (table, store.recent('f.refresh_dt', MAX_AGE), where)
+    return store.read_frame(qry, params, index_col='ticker')
+
+
+def predict(num_stocks, db, twitter_kwargs, order=ranking.LEXICOGRAPHIC):
+    stocks = get_stocks(db)
+    rank = rank_stocks(stocks, num_stocks, order)
+    return publish_to_twitter(rank.T, **twitter_kwargs)
 
 
 def main():
@@ -81,34 +130,43 @@ def main():
                         default=15,
                         type=int,
                         help='Number of stocks to publish')
+    parser.add_argument('-o', '--order',
+                        default=ranking.LEXICOGRAPHIC,
+                        choices=(ranking.LEXICOGRAPHIC, ranking.COMBINED),
+                        help='Order by P/E then return, or by the sum of '
+                             'both ranks')
     parser.add_argument('-h', '--host',
-                        required=True,
                         help='MySQL host')
     parser.add_argument('-u', '--user',
-                        required=True,
                         help='MySQL User')
     parser.add_argument('-p', '--password',
-                        required=True,
                         help='MySQL password')
     parser.add_argument('database',
-                        help='Database to store tickers in')
+                        help='Database to store tickers in, the file for '
+                             'sqlite')
+    parser.add_argument('--engine',
+                        choices=storage.ENGINES,
+                        default=storage.MYSQL,
+                        help='Read from MySQL or from a sqlite file')
     parser.add_argument('--help',
                         action='help', default=argparse.SUPPRESS,
                         help='show this help message and exit')
 
     args = parser.parse_args()
 
-    db_kwargs = {'host': args.host,
-                 'user': args.user,
-                 'passwd': args.password,
-                 'db': args.database}
+    if args.engine == storage.MYSQL and not (args.host and args.user and
+                                             args.password):
+        parser.error('MySQL needs --host, --user and --password')
+
+    store = storage.backend(args.engine, args.database, args.host,
+                            args.user, args.password)
 
     twitter_kwargs = {'consumer_key': args.consumer_key,
                       'consumer_secret': args.consumer_secret,
                       'access_token_key': args.access_token_key,
                       'access_token_secret': args.access_token_secret}
 
-    if predict(args.num_stocks, db_kwargs, twitter_kwargs):
+    if predict(args.num_stocks, store, twitter_kwargs, args.order):
         return 0
 
     return 1
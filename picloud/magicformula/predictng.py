@@ -2,12 +2,16 @@
 
 import argparse
 import sys
+from multiprocessing import pool
 
 import eoddata
-import numpy as np
 import pandas as pd
 import twitter
 
+import ranking
+import screen
+import snapshots
+
 
 EXCLUDED_SECTORS = ('Finance - Savings and Loans',
                     'Closed-End Investment Bond Funds',
@@ -46,6 +50,24 @@ EXCLUDED_INDUSTRIES = ('Power Generation',  # Utilites
                        'Oilfield Services/Equipment',
                        'Independent Oil & Gas',
                        'Natural Gas Distribution')
+EXCLUDED_DESCRIPTIONS = ('energy', 'financ', 'invest', 'bank', 'banc',
+                         'equity')
+EXCLUDED_SUFFIXES = (' ads', ' adr', ' s.a.')
+THRESHOLDS = (('market_cap', '>=', 50000000),
+              ('pe', '>', 5),
+              ('pe', '<', 25),
+              ('yield', '>', 6),
+              ('roc', '>', 0))
+
+EXCHANGES = ('NYSE', 'NASDAQ')
+RANKS = (('pe_rank', 'pe', True, 'min'),
+         ('roc_rank', 'roc', False, 'max'))
+
+SCREEN = screen.Screen(excluded_sectors=EXCLUDED_SECTORS,
+                       excluded_industries=EXCLUDED_INDUSTRIES,
+                       description_contains=EXCLUDED_DESCRIPTIONS,
+                       description_endswith=EXCLUDED_SUFFIXES,
+                       thresholds=THRESHOLDS)
 
 
 def publish_to_twitter(df, prefix='MF', api=None, **kwargs):
@@ -61,54 +83,65 @@ def publish_to_twitter(df, prefix='MF', api=None, **kwargs):
     return api.PostUpdate(msg)
 
 
-def rank_stocks(df):
-    df['roc_rank'] = df['roc'].rank(method='max', ascending=0)
-    df['yield_rank'] = df['yield'].rank(method='max', ascending=0)
-    df['pe_rank'] = df['pe'].rank(method='min', ascending=1)
-    return df.sort_index(by=['pe_rank', 'roc_rank'],
-                         ascending=[1, 1])
+def rank_stocks(df, num_stocks=None, order=ranking.LEXICOGRAPHIC):
+    return ranking.rank_frame(df, RANKS, num_stocks, order)
 
 
-def get_stocks(eod_kwargs):
+def fetch_fundamentals(eod_kwargs, exchange):
+    # eoddata clients hold a session token, one per thread
     client = eoddata.Client(**eod_kwargs)
-    fundamentals = {}
-
-    for exchange in ('NYSE', 'NASDAQ'):
-        fundamentals.update(client.fundamentals(exchange))
-
-    df = pd.DataFrame(fundamentals).T
-
-    for col in ('market_cap', 'pt_b', 'ebitda', 'pe', 'yield'):
-        df[col] = df[col].astype(np.float64)
-
-    df = df[df['market_cap'] >= 50000000]
-    df = df[df['pe'] > 5]
-    df = df[df['pe'] < 25]
-    df = df[df['yield'] > 6]
-    df = df[df['sector'].map(lambda x: x not in EXCLUDED_SECTORS)]
-    df = df[df['industry'].map(lambda x: x not in EXCLUDED_INDUSTRIES)]
-    df = df[df['description'].map(lambda x: 'energy' not in x.lower())]
-    df = df[df['description'].map(lambda x: 'financ' not in x.lower())]
-    df = df[df['description'].map(lambda x: 'invest' not in x.lower())]
-    df = df[df['description'].map(lambda x: 'bank' not in x.lower())]
-    df = df[df['description'].map(lambda x: 'banc' not in x.lower())]
-    df = df[df['description'].map(lambda x: 'equity' not in x.lower())]
-    df = df[df['description'].map(lambda x: not x.lower().endswith(' ads'))]
-    df = df[df['description'].map(lambda x: not x.lower().endswith(' adr'))]
-    df = df[df['description'].map(lambda x: not x.lower().endswith(' s.a.'))]
-
+    return snapshots.frame(client.fundamentals(exchange))
+
+
+def get_fundamentals(eod_kwargs, store=None, date=None, refresh=False,
+                     exchanges=EXCHANGES):
+    frames = {}
+    fetch = []
+
+    for exchange in exchanges:
+        # A dated run is a replay of what was stored, eoddata only has today
+        if store is not None and (date is not None or
+                                  (not refresh and store.exists(exchange))):
+            frames[exchange] = store.read(exchange, date)
+        else:
+            fetch.append(exchange)
+
+    if fetch:
+        workers = pool.ThreadPool(len(fetch))
+        try:
+            results = workers.map(lambda e: fetch_fundamentals(eod_kwargs, e),
+                                  fetch)
+        finally:
+            workers.close()
+            workers.join()
+
+        for exchange, df in zip(fetch, results):
+            if store is not None:
+                store.write(exchange, df)
+            frames[exchange] = df
+
+    df = pd.concat([frames[exchange] for exchange in exchanges])
+    # Later exchanges win, same as updating one dict with each of them
+    return df[~df.index.duplicated(keep='last')].sort_index()
+
+
+def add_roc(df):
     df['assets'] = df['market_cap'] / df['pt_b']
     df['roc'] = df['ebitda'] / df['assets']
+    return df
 
-    df = df[df['roc'] > 0]
 
-    return df
+def get_stocks(eod_kwargs, store=None, date=None, refresh=False,
+               exchanges=EXCHANGES):
+    df = get_fundamentals(eod_kwargs, store, date, refresh, exchanges)
+    return SCREEN.apply(add_roc(df))
 
 
-def predict(num_stocks, eod_kwargs, twitter_kwargs):
-    stocks = get_stocks(eod_kwargs)
-    rank = rank_stocks(stocks)
-    return publish_to_twitter(rank[:num_stocks].T, **twitter_kwargs)
+def predict(num_stocks, eod_kwargs, twitter_kwargs, store=None, date=None,
+            refresh=False, exchanges=EXCHANGES, order=ranking.LEXICOGRAPHIC):
+    stocks = get_stocks(eod_kwargs, store, date, refresh, exchanges)
+    rank = rank_stocks(stocks, num_stocks, order)
+    return publish_to_twitter(rank.T, **twitter_kwargs)
 
 
 def main():
@@ -130,15 +163,44 @@ def main():
                         default=15,
                         type=int,
                         help='Number of stocks to publish')
+    parser.add_argument('-o', '--order',
+                        default=ranking.LEXICOGRAPHIC,
+                        choices=(ranking.LEXICOGRAPHIC, ranking.COMBINED),
+                        help='Order by P/E then return, or by the sum of '
+                             'both ranks')
     parser.add_argument('-u', '--user',
                         required=True,
                         help='EOD Data User')
     parser.add_argument('-p', '--password',
                         required=True,
                         help='EOD Data password')
+    parser.add_argument('-e', '--exchange',
+                        action='append',
+                        dest='exchanges',
+                        help='Exchange to screen, may be repeated '
+                             '(default: %s)' % ', '.join(EXCHANGES))
+    parser.add_argument('--snapshot-dir',
+                        default=None,
+                        help='Store fundamentals snapshots here and reuse '
+                             'today\'s instead of downloading them again')
+    parser.add_argument('--date',
+                        default=None,
+                        help='Predict from the stored snapshot of this date '
+                             '(YYYY-MM-DD), needs --snapshot-dir')
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help='Download today\'s fundamentals even if they '
+                             'are already stored')
 
     args = parser.parse_args()
 
+    if args.date and not args.snapshot_dir:
+        parser.error('--date needs --snapshot-dir')
+
+    store = None
+    if args.snapshot_dir:
+        store = snapshots.SnapshotStore(args.snapshot_dir)
+
     eod_kwargs = {'username': args.user,
                   'password': args.password}
 
@@ -147,7 +209,8 @@ def main():
                       'access_token_key': args.access_token_key,
                       'access_token_secret': args.access_token_secret}
 
-    if predict(args.num_stocks, eod_kwargs, twitter_kwargs):
+    if predict(args.num_stocks, eod_kwargs, twitter_kwargs, store, args.date,
+               args.refresh, args.exchanges or EXCHANGES, args.order):
         return 0
 
     return 1
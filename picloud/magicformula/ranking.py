@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+
+
+LEXICOGRAPHIC = 'lexicographic'
+COMBINED = 'combined'
+
+# Up to this many selected rows are ranked by counting instead of sorting
+COUNT_RANKS = 64
+COUNT_CHUNK = 8
+
+
+def sort_key(values, ascending=True):
+    # Smaller is better and NaN sorts last, whichever way the column ranks
+    values = np.asarray(values, dtype=np.float64)
+    if ascending:
+        return values
+    return -values
+
+
+def _group_codes(groups, n):
+    if groups is None:
+        return np.zeros(n, dtype=np.int64)
+    return pd.factorize(np.asarray(groups))[0]
+
+
+# Same numbers as Series.rank(method=...) for 'min' and 'max', NaN stays NaN.
+# With groups every group is ranked on its own
+def rank(values, ascending=True, method='min', groups=None):
+    key = sort_key(values, ascending)
+    n = len(key)
+    codes = _group_codes(groups, n)
+
+    if groups is None:
+        order = np.argsort(key, kind='mergesort')
+    else:
+        order = np.lexsort((key, codes))
+    sorted_key = key[order]
+    sorted_codes = codes[order]
+    pos = np.arange(n)
+
+    group_start = np.ones(n, dtype=bool)
+    group_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    tie_start = group_start.copy()
+    tie_start[1:] |= sorted_key[1:] != sorted_key[:-1]
+
+    first = np.maximum.accumulate(np.where(group_start, pos, 0))
+    if method == 'min':
+        at = np.maximum.accumulate(np.where(tie_start, pos, 0))
+    elif method == 'max':
+        tie_end = np.ones(n, dtype=bool)
+        tie_end[:-1] = tie_start[1:]
+        at = np.minimum.accumulate(np.where(tie_end, pos, n)[::-1])[::-1]
+    else:
+        raise ValueError('Unsupported rank method %r' % method)
+
+    out = np.empty(n, dtype=np.float64)
+    out[order] = at - first + 1
+    out[np.isnan(key)] = np.nan
+    return out
+
+
+def rank_rows(values, rows, ascending=True, method='min'):
+    # Ranks of a few rows against the whole column without sorting it
+    rows = np.asarray(rows)
+    if len(rows) > COUNT_RANKS:
+        return rank(values, ascending, method)[rows]
+
+    if method not in ('min', 'max'):
+        raise ValueError('Unsupported rank method %r' % method)
+
+    key = sort_key(values, ascending)
+    out = np.empty(len(rows), dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        for i in xrange(0, len(rows), COUNT_CHUNK):
+            chunk = key[rows[i:i + COUNT_CHUNK]][:, None]
+            if method == 'min':
+                out[i:i + COUNT_CHUNK] = (key < chunk).sum(1) + 1
+            else:
+                out[i:i + COUNT_CHUNK] = (key <= chunk).sum(1)
+
+    out[np.isnan(key[rows])] = np.nan
+    return out
+
+
+# Positions of the k best rows ordered by keys[0], then keys[1] and so on,
+# smallest first. Only rows tied with the k-th best on the first key are
+# sorted, the rest are dropped by a partition
+def top_k(keys, k=None):
+    keys = [np.asarray(key, dtype=np.float64) for key in keys]
+    n = len(keys[0])
+    rows = np.arange(n)
+
+    if k is not None and k < n:
+        first = keys[0]
+        valid = np.flatnonzero(~np.isnan(first))
+        if len(valid) > k:
+            kth = np.partition(first[valid], k - 1)[k - 1]
+            with np.errstate(invalid='ignore'):
+                rows = np.flatnonzero(first <= kth)
+
+    order = np.lexsort([key[rows] for key in reversed(keys)])
+    return rows[order][:k]
+
+
+# Best k rows of every group, ordered the same way as top_k. Returns the
+# row positions, group by group
+def top_k_groups(groups, keys, k):
+    keys = [np.asarray(key, dtype=np.float64) for key in keys]
+    codes = _group_codes(groups, len(keys[0]))
+
+    order = np.lexsort([key for key in reversed(keys)] + [codes])
+    sorted_codes = codes[order]
+    start = np.ones(len(order), dtype=bool)
+    start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+
+    pos = np.arange(len(order))
+    within = pos - np.maximum.accumulate(np.where(start, pos, 0))
+    return order[within < k]
+
+
+# ranks is a sequence of (name, column, ascending, method). A lexicographic
+# order sorts by each rank in turn, the combined order sorts by the sum of
+# the ranks (the Magic Formula) and breaks ties in rank order. Returns a
+# new frame holding the best num rows with the rank columns added, df is
+# left alone
+def rank_frame(df, ranks, num=None, order=LEXICOGRAPHIC):
+    columns = [(name, df[column].values, ascending, method)
+               for name, column, ascending, method in ranks]
+
+    if order == LEXICOGRAPHIC:
+        rows = top_k([sort_key(values, ascending)
+                      for name, values, ascending, method in columns], num)
+        ranked = [(name, rank_rows(values, rows, ascending, method))
+                  for name, values, ascending, method in columns]
+
+    elif order == COMBINED:
+        full = [rank(values, ascending, method)
+                for name, values, ascending, method in columns]
+        rows = top_k([sum(full)] + full, num)
+        ranked = [(column[0], values[rows])
+                  for column, values in zip(columns, full)]
+
+    else:
+        raise ValueError('Unknown rank order %r' % order)
+
+    out = df.iloc[rows].copy()
+    for name, values in ranked:
+        out[name] = values
+    return out
+
+
+# rank_frame for every group at once, e.g. every date of a panel. Rank
+# columns are within the group and the rows come back group by group
+def rank_groups(df, ranks, groups, num=None, order=LEXICOGRAPHIC):
+    groups = np.asarray(groups)
+    columns = [(name, df[column].values, ascending, method)
+               for name, column, ascending, method in ranks]
+    full = [rank(values, ascending, method, groups)
+            for name, values, ascending, method in columns]
+
+    if order == LEXICOGRAPHIC:
+        keys = full
+    elif order == COMBINED:
+        keys = [sum(full)] + full
+    else:
+        raise ValueError('Unknown rank order %r' % order)
+
+    if num is None:
+        num = len(df)
+
+    rows = top_k_groups(groups, keys, num)
+    out = df.iloc[rows].copy()
+    for column, values in zip(columns, full):
+        out[column[0]] = values[rows]
+    return out
@@ -0,0 +1,58 @@
+import operator
+import re
+
+import numpy as np
+
+
+OPERATORS = {'<': operator.lt,
+             '<=': operator.le,
+             '>': operator.gt,
+             '>=': operator.ge,
+             '==': operator.eq,
+             '!=': operator.ne}
+
+
+class Screen(object):
+    def __init__(self, excluded_sectors=(), excluded_industries=(),
+                 description_contains=(), description_endswith=(),
+                 thresholds=()):
+        self.excluded_sectors = frozenset(excluded_sectors)
+        self.excluded_industries = frozenset(excluded_industries)
+        self.thresholds = [(column, OPERATORS[op], value)
+                           for column, op, value in thresholds]
+
+        patterns = ([re.escape(s.lower()) for s in description_contains] +
+                    [re.escape(s.lower()) + r'\Z'
+                     for s in description_endswith])
+        self.description_re = None
+        if patterns:
+            self.description_re = '|'.join(patterns)
+
+    def numeric_mask(self, df):
+        mask = np.ones(len(df), dtype=bool)
+        # NaN never passes a threshold, same as filtering the frame
+        with np.errstate(invalid='ignore'):
+            for column, op, value in self.thresholds:
+                mask &= op(df[column].values, value)
+        return mask
+
+    def mask(self, df):
+        mask = self.numeric_mask(df)
+
+        if self.excluded_sectors:
+            mask &= ~df['sector'].isin(self.excluded_sectors).values
+
+        if self.excluded_industries:
+            mask &= ~df['industry'].isin(self.excluded_industries).values
+
+        # The regex is the expensive part, only run it on what is left
+        if self.description_re is not None and mask.any():
+            rows = np.flatnonzero(mask)
+            description = df['description'].iloc[rows].fillna('').str.lower()
+            excluded = description.str.contains(self.description_re).values
+            mask[rows[excluded.astype(bool)]] = False
+
+        return mask
+
+    def apply(self, df):
+        return df[self.mask(df)]
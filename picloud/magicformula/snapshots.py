@@ -0,0 +1,124 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+NUMERIC = ('market_cap', 'pt_b', 'ebitda', 'pe', 'yield')
+
+INDEX = '_index'
+META = 'meta.json'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def _date(date):
+    if date is None:
+        date = datetime.date.today()
+    if isinstance(date, basestring):
+        return date
+    return date.strftime(DATE_FORMAT)
+
+
+def _text(values):
+    values = np.asarray(values, dtype=object)
+    values = np.where(pd.isnull(values), u'', values)
+    return np.array([unicode(v) for v in values], dtype=np.unicode_)
+
+
+# Typed columns for an eoddata fundamentals dict, {symbol: {field: value}}
+def frame(fundamentals, numeric=NUMERIC):
+    df = pd.DataFrame.from_dict(fundamentals, orient='index')
+    for column in numeric:
+        if column in df:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+# One directory per exchange and date, holding one .npy file per column.
+# Numeric columns are float64 and text columns fixed width unicode, so a
+# snapshot loads memory mapped straight into typed columns. Each snapshot
+# is written on its own and renamed into place, the others are never
+# touched.
+class SnapshotStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, exchange, date=None):
+        return os.path.join(self.directory, exchange, _date(date))
+
+    def exists(self, exchange, date=None):
+        return os.path.exists(os.path.join(self.path(exchange, date), META))
+
+    def dates(self, exchange):
+        path = os.path.join(self.directory, exchange)
+        if not os.path.isdir(path):
+            return []
+        return sorted(d for d in os.listdir(path)
+                      if os.path.exists(os.path.join(path, d, META)))
+
+    def latest(self, exchange):
+        dates = self.dates(exchange)
+        if dates:
+            return dates[-1]
+
+    def write(self, exchange, df, date=None):
+        path = self.path(exchange, date)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            columns = []
+            for column in df.columns:
+                values = df[column].values
+                if values.dtype.kind not in 'biuf':
+                    values = _text(values)
+                np.save(os.path.join(tmp, '%d.npy' % len(columns)), values)
+                columns.append(column)
+
+            np.save(os.path.join(tmp, INDEX + '.npy'), _text(df.index))
+
+            with open(os.path.join(tmp, META), 'w') as f:
+                json.dump({'exchange': exchange,
+                           'date': _date(date),
+                           'columns': columns,
+                           'rows': len(df)}, f)
+
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        return path
+
+    def read(self, exchange, date=None, columns=None, mmap=True):
+        path = self.path(exchange, date)
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+
+        mmap_mode = 'r' if mmap else None
+        if columns is None:
+            columns = meta['columns']
+
+        data = {}
+        for column in columns:
+            i = meta['columns'].index(column)
+            data[column] = np.load(os.path.join(path, '%d.npy' % i),
+                                   mmap_mode=mmap_mode)
+
+        index = np.load(os.path.join(path, INDEX + '.npy'),
+                        mmap_mode=mmap_mode)
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def load(self, exchanges, date=None, columns=None, mmap=True):
+        return pd.concat([self.read(exchange, date, columns, mmap)
+                          for exchange in exchanges])
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+import predict
+import predictng
+import ranking
+import screen
+import snapshots
+
+
+THRESHOLD_RE = re.compile(r'^(\w+)\s*(<=|>=|<|>)\s*(.+)$')
+
+
+# One column sorted once. A threshold on it is then a contiguous run of
+# that order, so its mask is a slice instead of a comparison
+class SortedColumn(object):
+    def __init__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.order = np.argsort(values, kind='mergesort')
+        self.values = values[self.order]
+        self.valid = int((~np.isnan(self.values)).sum())
+
+    def bounds(self, op, value):
+        valid = self.values[:self.valid]
+        if op in ('>', '>='):
+            side = 'right' if op == '>' else 'left'
+            return np.searchsorted(valid, value, side=side), self.valid
+        if op in ('<', '<='):
+            side = 'left' if op == '<' else 'right'
+            return 0, np.searchsorted(valid, value, side=side)
+        raise ValueError('Can not sweep %r' % op)
+
+    def mask(self, op, value):
+        mask = np.zeros(len(self.order), dtype=bool)
+        start, stop = self.bounds(op, value)
+        mask[self.order[start:stop]] = True
+        return mask
+
+
+# A rank column sorted once. The rank of a row among any subset is a
+# running count of the subset along that order, so re-ranking the
+# survivors of a screen needs no sort
+class SortedRank(object):
+    def __init__(self, values, ascending=True, method='min'):
+        key = ranking.sort_key(values, ascending)
+        n = len(key)
+        self.order = np.argsort(key, kind='mergesort')
+        self.method = method
+
+        sorted_key = key[self.order]
+        pos = np.arange(n)
+        start = np.ones(n, dtype=bool)
+        start[1:] = sorted_key[1:] != sorted_key[:-1]
+        end = np.ones(n, dtype=bool)
+        end[:-1] = start[1:]
+
+        self.start = np.maximum.accumulate(np.where(start, pos, 0))
+        self.end = np.minimum.accumulate(np.where(end, pos, n)[::-1])[::-1]
+        self.nan = np.isnan(key)
+
+    def rank(self, mask):
+        seen = np.cumsum(mask[self.order])
+        if self.method == 'min':
+            ranks = np.where(self.start > 0, seen[self.start - 1], 0) + 1
+        else:
+            ranks = seen[self.end]
+
+        out = np.empty(len(ranks), dtype=np.float64)
+        out[self.order] = ranks
+        out[self.nan] = np.nan
+        return out
+
+
+# Evaluates every combination of a threshold grid over one frame. grid is
+# a sequence of (column, op, values); fixed is a Screen of everything that
+# stays put and is applied once. Each threshold value becomes a bitset built
+# from its column's sort order, so a grid point costs a few ands plus a
+# top-k pass over the rank order.
+class Sweep(object):
+    def __init__(self, df, grid, fixed=None, ranks=predictng.RANKS,
+                 num_stocks=15, order=ranking.LEXICOGRAPHIC):
+        self.df = df
+        self.grid = [(column, op, list(values))
+                     for column, op, values in grid]
+        self.num_stocks = num_stocks
+        self.order = order
+
+        n = len(df)
+        base = np.ones(n, dtype=bool) if fixed is None else fixed.mask(df)
+        self.base = np.packbits(base)
+
+        columns = {}
+        self.bitsets = []
+        for column, op, values in self.grid:
+            if column not in columns:
+                columns[column] = SortedColumn(df[column].values)
+            self.bitsets.append([np.packbits(columns[column].mask(op, v))
+                                 for v in values])
+
+        self.ranks = [(name, SortedRank(df[column].values, ascending, method))
+                      for name, column, ascending, method in ranks]
+
+        # Lexicographic order does not depend on which rows survive
+        keys = [ranking.sort_key(df[column].values, ascending)
+                for name, column, ascending, method in ranks]
+        self.lex_order = np.lexsort(list(reversed(keys)))
+
+    def points(self):
+        return itertools.product(*[range(len(values))
+                                   for column, op, values in self.grid])
+
+    def mask(self, point):
+        bits = self.base.copy()
+        for bitsets, i in zip(self.bitsets, point):
+            np.bitwise_and(bits, bitsets[i], out=bits)
+        return np.unpackbits(bits)[:len(self.df)].astype(bool)
+
+    def top(self, mask):
+        if self.order == ranking.LEXICOGRAPHIC:
+            rows = self.lex_order[mask[self.lex_order]]
+            return rows[:self.num_stocks]
+
+        full = [sorted_rank.rank(mask) for name, sorted_rank in self.ranks]
+        survivors = np.flatnonzero(mask)
+        keys = [sum(full)[survivors]] + [r[survivors] for r in full]
+        return survivors[ranking.top_k(keys, self.num_stocks)]
+
+    def run(self):
+        names = ['%s %s' % (column, op) for column, op, values in self.grid]
+        index = self.df.index.values
+        results = []
+
+        for point in self.points():
+            mask = self.mask(point)
+            rows = self.top(mask)
+            result = dict((name, values[i]) for name, (c, o, values), i
+                          in zip(names, self.grid, point))
+            result['count'] = int(mask.sum())
+            result['stocks'] = ' '.join(str(s) for s in index[rows])
+            results.append(result)
+
+        return pd.DataFrame(results, columns=names + ['count', 'stocks'])
+
+
+def parse_threshold(spec):
+    match = THRESHOLD_RE.match(spec)
+    if not match:
+        raise argparse.ArgumentTypeError('Expected column<op>v1,v2,... '
+                                         'got %r' % spec)
+    column, op, values = match.groups()
+    return column, op, [float(v) for v in values.split(',')]
+
+
+def fixed_screen(module, grid):
+    # The module's own screen without the thresholds being swept
+    swept = set((column, op) for column, op, values in grid)
+    return screen.Screen(
+        excluded_sectors=module.EXCLUDED_SECTORS,
+        excluded_industries=module.EXCLUDED_INDUSTRIES,
+        description_contains=getattr(module, 'EXCLUDED_DESCRIPTIONS', ()),
+        description_endswith=getattr(module, 'EXCLUDED_SUFFIXES', ()),
+        thresholds=[t for t in module.THRESHOLDS if t[:2] not in swept])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep MagicFormula screen '
+                                                 'thresholds',
+                                     add_help=False)
+    parser.add_argument('thresholds',
+                        nargs='+',
+                        type=parse_threshold,
+                        help='Thresholds to sweep, e.g. "pe>3,5,7"')
+    parser.add_argument('-n', '--num_stocks',
+                        default=15,
+                        type=int,
+                        help='Number of stocks per screen')
+    parser.add_argument('-o', '--order',
+                        default=ranking.LEXICOGRAPHIC,
+                        choices=(ranking.LEXICOGRAPHIC, ranking.COMBINED),
+                        help='Order by P/E then return, or by the sum of '
+                             'both ranks')
+    parser.add_argument('--snapshot-dir',
+                        default=None,
+                        help='Sweep a stored eoddata snapshot with the '
+                             'predictng screen instead of MySQL')
+    parser.add_argument('--date',
+                        default=None,
+                        help='Snapshot date (YYYY-MM-DD, default: today)')
+    parser.add_argument('-e', '--exchange',
+                        action='append',
+                        dest='exchanges',
+                        help='Snapshot exchange, may be repeated')
+    parser.add_argument('-h', '--host',
+                        help='MySQL host')
+    parser.add_argument('-u', '--user',
+                        help='MySQL User')
+    parser.add_argument('-p', '--password',
+                        help='MySQL password')
+    parser.add_argument('database',
+                        nargs='?',
+                        help='Database the fundamentals are stored in')
+    parser.add_argument('--help',
+                        action='help', default=argparse.SUPPRESS,
+                        help='show this help message and exit')
+
+    args = parser.parse_args()
+
+    if args.snapshot_dir:
+        store = snapshots.SnapshotStore(args.snapshot_dir)
+        df = store.load(args.exchanges or predictng.EXCHANGES, args.date)
+        df = predictng.add_roc(df[~df.index.duplicated(keep='last')])
+        module = predictng
+
+    else:
+        if not (args.host and args.user and args.database):
+            parser.error('MySQL host, user and database are required '
+                         'without --snapshot-dir')
+
+        db_kwargs = {'host': args.host,
+                     'user': args.user,
+                     'passwd': args.password,
+                     'db': args.database}
+        df = predict.get_latest(db_kwargs)
+        module = predict
+
+    sweep = Sweep(df, args.thresholds, fixed_screen(module, args.thresholds),
+                  module.RANKS, args.num_stocks, args.order)
+    sweep.run().to_csv(sys.stdout, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import logging
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+import zipfile
+
+
+LOG = logging.getLogger(__name__)
+
+INDEX = 'index.json'
+PAGES = 'pages/'
+HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+# Writes every page a session fetches into a zip. Bodies are stored once
+# per sha1, deflated, and index.json maps each url to its digest and what
+# is needed to serve it again. The zip's own directory makes every body
+# one seek away when replaying.
+class Recorder(object):
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self._digests = set()
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                                    allowZip64=True)
+        self._lock = threading.Lock()
+
+    def record(self, url, r, elapsed):
+        if r.status_code != 200:
+            LOG.debug('Not recording %s, status %s', url, r.status_code)
+            return
+
+        body = r.content
+        digest = hashlib.sha1(body).hexdigest()
+        entry = {'digest': digest,
+                 'encoding': r.encoding,
+                 'elapsed': elapsed,
+                 'headers': dict((k, r.headers[k]) for k in HEADERS
+                                 if k in r.headers)}
+
+        with self._lock:
+            if digest not in self._digests:
+                self._zip.writestr(PAGES + digest, body)
+                self._digests.add(digest)
+            self.index[url] = entry
+
+    def close(self):
+        with self._lock:
+            if self._zip is None:
+                return
+            self._zip.writestr(INDEX, json.dumps(self.index, sort_keys=True))
+            self._zip.close()
+            self._zip = None
+        LOG.info('Recorded %s pages to %s', len(self.index), self.path)
+
+
+class RecordingSession(object):
+    def __init__(self, session, recorder):
+        self.session = session
+        self.recorder = recorder
+
+    def get(self, url, **kwargs):
+        start = time.time()
+        r = self.session.get(url, **kwargs)
+        self.recorder.record(url, r, time.time() - start)
+        return r
+
+    def close(self):
+        self.session.close()
+
+
+class Archive(object):
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path)
+        self.index = json.loads(self._zip.read(INDEX))
+        self._lock = threading.Lock()
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, url):
+        # (entry, body), or None for a url that was never recorded
+        entry = self.index.get(url)
+        if entry is None:
+            return
+        with self._lock:
+            return entry, self._zip.read(PAGES + entry['digest'])
+
+    def close(self):
+        self._zip.close()
+
+
+# Stands in for the hosts an archive was recorded from. The original url
+# is the request path with its leading slash dropped, e.g.
+# /biz.yahoo.com/p/sum_conameu.html. Every response waits latency plus up
+# to jitter seconds, error_rate of them are a 503 and drop_rate of them
+# close the connection without answering.
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response into one write, headers and body written
+    # separately stall on delayed acks
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.delay())
+
+        fault = server.fault()
+        if fault == 'drop':
+            self.close_connection = 1
+            return
+        if fault == 'error':
+            self.send_error(503)
+            return
+
+        page = server.archive.get('http://' + self.path.lstrip('/'))
+        if page is None:
+            self.send_error(404)
+            return
+
+        entry, body = page
+        self.send_response(200)
+        for name, value in entry['headers'].iteritems():
+            self.send_header(name, value)
+        if 'Content-Type' not in entry['headers']:
+            self.send_header('Content-Type',
+                             'text/html; charset=%s' %
+                             (entry['encoding'] or 'utf-8'))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt, *args)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, archive, address=('127.0.0.1', 0), latency=0,
+                 jitter=0, error_rate=0, drop_rate=0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.archive = archive
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def delay(self):
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def fault(self):
+        with self._lock:
+            x = self._random.random()
+        if x < self.drop_rate:
+            return 'drop'
+        if x < self.drop_rate + self.error_rate:
+            return 'error'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='replay-http')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+# Sends every request to a ReplayServer instead of the url's own host.
+# Sits under PooledSession and RateLimitedSession so those still see, and
+# limit by, the original hosts
+class ReplaySession(object):
+    def __init__(self, session, base_url):
+        self.session = session
+        self.base_url = base_url.rstrip('/')
+
+    def local_url(self, url):
+        parts = urlparse.urlsplit(url)
+        local = '%s/%s%s' % (self.base_url, parts.netloc, parts.path)
+        if parts.query:
+            local += '?' + parts.query
+        return local
+
+    def get(self, url, **kwargs):
+        return self.session.get(self.local_url(url), **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a recorded crawl as '
+                                                 'a stand-in for its hosts',
+                                     add_help=False)
+    parser.add_argument('archive',
+                        help='Archive written by fetch.py --record')
+    parser.add_argument('-h', '--host',
+                        default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('-P', '--port',
+                        default=8000,
+                        type=int,
+                        help='Port to listen on')
+    parser.add_argument('--latency',
+                        default=0,
+                        type=float,
+                        help='Seconds to wait before every response')
+    parser.add_argument('--jitter',
+                        default=0,
+                        type=float,
+                        help='Up to this many more seconds, at random')
+    parser.add_argument('--error-rate',
+                        default=0,
+                        type=float,
+                        help='Fraction of requests answered with a 503')
+    parser.add_argument('--drop-rate',
+                        default=0,
+                        type=float,
+                        help='Fraction of requests whose connection is '
+                             'closed without an answer')
+    parser.add_argument('--seed',
+                        default=0,
+                        type=int,
+                        help='Seed for the latency and fault injection')
+    parser.add_argument('--help',
+                        action='help', default=argparse.SUPPRESS,
+                        help='show this help message and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    archive = Archive(args.archive)
+    server = ReplayServer(archive, (args.host, args.port),
+                          latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate,
+                          drop_rate=args.drop_rate, seed=args.seed)
+    LOG.info('Serving %s pages on %s', len(archive), server.url)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
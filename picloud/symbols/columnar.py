@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+
+SUFFIXES = {'B': 1000000000, 'M': 1000000, 'K': 1000,
+            'b': 1000000000, 'm': 1000000, 'k': 1000}
+
+
+# One row per value and one column per character position, the text and
+# the characters share memory so edits to one show in the other
+def _chars(values):
+    values = np.asarray(values, dtype=object).ravel()
+    text = np.where(pd.isnull(values), u'', values).astype(np.unicode_)
+
+    width = max(text.dtype.itemsize // 4, 1)
+    text = text.astype('U%d' % width)
+    return text, text.view(np.uint32).reshape(len(text), width)
+
+
+def _in(chars, choices):
+    mask = np.zeros(chars.shape, dtype=bool)
+    for c in choices:
+        mask |= chars == ord(c)
+    return mask
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+# float() of every value, NaN where it raises. Values that look like a
+# plain number, digits with at most a sign, a point and an exponent, are
+# converted in one go. The rest (n/a, inf, blanks around a number) go
+# through float() one at a time, and so does everything should one of the
+# plain ones raise after all
+def _to_float(text, chars):
+    digit = (chars >= ord('0')) & (chars <= ord('9'))
+    dot = chars == ord('.')
+    exp = _in(chars, 'eE')
+    sign = _in(chars, '+-')
+    lengths = (chars != 0).sum(1)
+    last = chars[np.arange(len(text)), np.maximum(lengths - 1, 0)]
+
+    plain = ((digit | dot | exp | sign | (chars == 0)).all(1) &
+             digit.any(1) & (dot.sum(1) <= 1) & (exp.sum(1) <= 1) &
+             ~exp[:, 0] & ((last == ord('.')) |
+                           ((last >= ord('0')) & (last <= ord('9')))))
+    # A sign leads the number or the exponent, which follows a digit and
+    # the point
+    plain &= ~(sign[:, 1:] & ~exp[:, :-1]).any(1)
+    at = np.where(exp.any(1), exp.argmax(1), chars.shape[1])
+    plain &= (digit.argmax(1) < at) & (~dot.any(1) | (dot.argmax(1) < at))
+
+    out = np.empty(len(text), dtype=np.float64)
+    out.fill(np.nan)
+    rows = np.flatnonzero(plain)
+    try:
+        out[rows] = text[rows].astype(object).astype(np.float64)
+        rows = np.flatnonzero(~plain)
+    except ValueError:
+        rows = np.arange(len(text))
+
+    if len(rows):
+        out[rows] = [_float(value) for value in text[rows]]
+    return out
+
+
+# numify over the distinct values of a column: a B/M/K suffix is stripped
+# and multiplied in, a % anywhere else is stripped and divided out, and
+# commas go in either case. The characters are edited in place, only the
+# values with something to strip are moved around
+def _numify(values):
+    text, chars = _chars(values)
+    rows = np.arange(len(text))
+    lengths = (chars != 0).sum(1)
+    last = chars[rows, np.maximum(lengths - 1, 0)]
+
+    mult = np.zeros(len(text))
+    for suffix, factor in SUFFIXES.items():
+        mult[last == ord(suffix)] = factor
+    suffixed = mult > 0
+    chars[rows[suffixed], lengths[suffixed] - 1] = 0
+
+    drop = _in(chars, ',%')
+    marked = (chars == ord('%')).any(1)
+    percent = ~suffixed & marked
+
+    dirty = np.flatnonzero(drop.any(1))
+    if len(dirty):
+        order = np.argsort(drop[dirty], axis=1, kind='mergesort')
+        moved = np.take_along_axis(chars[dirty], order, axis=1)
+        moved[np.take_along_axis(drop[dirty], order, axis=1)] = 0
+        chars[dirty] = moved
+
+    out = _to_float(text, chars)
+    # Left in front of a suffix a % is something float() turns down
+    out[suffixed & marked] = np.nan
+
+    # numify int()s a suffixed value, which raises on inf and NaN
+    with np.errstate(over='ignore', invalid='ignore'):
+        scaled = np.trunc(out[suffixed] * mult[suffixed])
+    scaled[~np.isfinite(scaled)] = np.nan
+    out[suffixed] = scaled
+    out[percent] /= 100.00
+    return out
+
+
+# Column-at-a-time fetch.numify. Every value numify turns into a number comes
+# out as the same float64, n/a, blanks and anything numify would hand back as
+# a non numeric string come out as NaN. Scraped columns repeat a lot (N/A,
+# 0.00%, common dates), so each distinct string is only converted once
+def numify_column(values):
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object).ravel())
+
+    out = np.empty(len(codes), dtype=np.float64)
+    out.fill(np.nan)
+    if len(uniques):
+        found = codes >= 0
+        out[found] = _numify(uniques)[codes[found]]
+
+    if isinstance(values, pd.Series):
+        return pd.Series(out, index=values.index, name=values.name)
+
+    return out
+
+
+def numify_frame(df, columns=None):
+    if columns is None:
+        columns = [c for c in df.columns if df[c].dtype == np.object_]
+
+    df = df.copy()
+    for column in columns:
+        df[column] = numify_column(df[column])
+    return df
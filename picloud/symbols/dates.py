@@ -0,0 +1,92 @@
+import collections
+import datetime
+import re
+import threading
+
+import parsedatetime as pdt
+
+
+CACHE_SIZE = 4096
+
+MONTHS = dict((m, i + 1) for i, m in enumerate(('jan', 'feb', 'mar', 'apr',
+                                                'may', 'jun', 'jul', 'aug',
+                                                'sep', 'oct', 'nov', 'dec')))
+
+# Yahoo writes full dates as "Dec 31, 2013", anything else (e.g. the year-less
+# "Dec 31" of Fiscal Year Ends) goes through parsedatetime
+DATE_RE = re.compile(r'^\s*([A-Za-z]{3})[a-z]*\.?\s+(\d{1,2}),?\s+(\d{4})\s*$')
+
+
+class LRUCache(object):
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DateParser(object):
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache = LRUCache(cache_size)
+        self.calendar = pdt.Calendar()
+        self._lock = threading.Lock()
+
+    def parse_fast(self, s):
+        match = DATE_RE.match(s)
+        if match is None:
+            return
+
+        month, day, year = match.groups()
+        month = MONTHS.get(month.lower())
+        if month is None:
+            return
+
+        try:
+            return datetime.datetime(int(year), month, int(day))
+        except ValueError:
+            return
+
+    def parse_slow(self, s):
+        # The Calendar keeps parse state on the instance
+        with self._lock:
+            time_tpl = self.calendar.parse(s)[0][:3]
+
+        # Only the date is meaningful, the time of day parsedatetime fills in
+        # is the time of the call and would be frozen by the cache anyway
+        return datetime.datetime(*time_tpl)
+
+    def parse(self, s):
+        value = self.cache.get(s)
+        if value is None:
+            value = self.parse_fast(s)
+            if value is None:
+                value = self.parse_slow(s)
+            self.cache.set(s, value)
+        return value
+
+
+PARSER = DateParser()
+
+
+def get_date(s):
+    if not isinstance(s, basestring):
+        return s
+    return PARSER.parse(s)
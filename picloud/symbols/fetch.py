@@ -3,17 +3,34 @@
 import argparse
 import collections
 import datetime
-import itertools
+import json
+import logging
+import operator
 import random
 import sys
+import time
+import urlparse
 
 import cloud
-import MySQLdb
-import parsedatetime as pdt
 import requests
 
 from lxml import etree
 
+import archive
+import dates
+import fetcher
+import journal
+import keystats as keystats_parser
+import metrics
+import pagecache
+import pipeline
+import ratelimit
+import records
+import shards
+import storage
+
+
+LOG = logging.getLogger(__name__)
 
 MIN_DELAY = 20
 MAX_DELAY = 120
@@ -85,14 +102,118 @@ KEY_MAP = {'Forward P/E': 'fw_pe',
 DATE_MAP = ['div_date', 'ex_div_date', 'fsc_year_end', 'last_split_date',
             'mrq']
 
+FUNDAMENTALS_FIELDS = ('10d_avg_vol', '200d_mavg', '3m_avg_vol',
+                       '5y_avg_div_yld', '50d_mavg', '52w_change',
+                       '52w_high', '52w_low', 'beta', 'bk_val_per_share_mrq',
+                       'cur_ratio_mrq', 'dil_eps_ttm', 'div_date', 'ebita_ttm',
+                       'ent_val', 'ent_val_ebita_ttm', 'ent_val_rev_ttm',
+                       'ex_div_date', 'fsc_year_end', 'float',
+                       'fw_ann_div_rate', 'fw_ann_div_yld', 'fw_pe',
+                       'gross_profit_ttm', 'last_split_date',
+                       'last_split_factor', 'levered_free_cash_flow_ttm',
+                       'market_cap', 'mrq', 'net_inc_avl_to_com_ttm',
+                       'op_cash_flow_ttm', 'op_margin_ttm', 'peg_ratio',
+                       'payout_ratio', 'insider_percent', 'inst_percent',
+                       'price_per_book_mrq', 'price_per_sales_ttm',
+                       'prior_m_shares_short', 'profit_margin_ttm',
+                       'qtrly_earnings_growth_yoy',
+                       'qtrly_revenue_growth_yoy',
+                       'roa_ttm', 'roe_ttm', 'revenue_ttm',
+                       'revenue_per_share_ttm', 'sp_52w_change',
+                       'shares_out', 'shares_short', 'short_percent_of_float',
+                       'short_ratio', 'cash_mrq', 'cash_per_share_mrq',
+                       'debt_mrq', 'debt_to_equity_mrq',
+                       'trailing_annual_div_yield', 'trailing_pe')
+
+# Stats the industry pages list for the sector and the industry of every
+# ticker, stored as sector_<field> and industry_<field>
+INDUSTRY_FIELDS = ('1d_price_change', 'market_cap', 'trailing_pe', 'roe_ttm',
+                   'trailing_annual_div_yield', 'debt_to_equity_mrq',
+                   'price_per_book_mrq')
+
+TICKERS_TABLE = 'tickers'
+FUNDAMENTALS_TABLE = 'fundamentals'
+
+# Column types of the fundamentals in tables created here, the rest are
+# DOUBLE
+FIELD_TYPES = dict([(name, 'DATE') for name in DATE_MAP],
+                   last_split_factor='VARCHAR(255)')
+
+# Sector and industry stats are kept once per sector and industry for every
+# day they are crawled, tickers only point at their industry
+SECTOR_STATS_TABLE = 'sector_stats'
+INDUSTRY_STATS_TABLE = 'industry_stats'
+
+# How long fetched keystats stay fresh for an incremental run. Market driven
+# stats (price, cap, ratios, volume) move daily but the screens only look
+# back a week. Quarterly stats (mrq/ttm) only change once the next quarter
+# has been filed, which is expected a quarter plus the filing lag after mrq.
+FRESHNESS = {'market': datetime.timedelta(days=5),
+             'quarter': datetime.timedelta(days=91),
+             'filing_lag': datetime.timedelta(days=45)}
+
+# Latest keystats row per ticker, kept up to date by KeystatsHandler so the
+# screens read one row per ticker instead of grouping the whole history
+LATEST_TABLE = 'fundamentals_latest'
+LATEST_INDEXES = (('roa_ttm',), ('trailing_pe',), ('market_cap',),
+                  ('sector', 'industry'))
+
+# Rows buffered by KeystatsHandler before they are written, or seconds since
+# the last write, whichever comes first
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 30
+
+# Anything with a requests style get(url) works here, the local runners
+# swap in a pooled session
+SESSION = requests
+
+# Set for local runs to pace requests per host instead of delaying messages
+RATE_LIMITER = None
+
+# Set for local runs to keep pages on disk between runs, see pagecache
+PAGE_CACHE = None
+CACHE_TTLS = [(pagecache.url_pattern(SECTOR_URL), 24 * 60 * 60),
+              (pagecache.url_pattern(INDUSTRY_URL), 6 * 60 * 60),
+              (pagecache.url_pattern(KEYSTATS_URL), 12 * 60 * 60)]
+
+# Set for sharded local runs, tracks which industries and tickers are
+# finished, see shards
+WORK_STORE = None
+INDUSTRY = 'industry'
+TICKER = 'ticker'
+
+# Set for local runs to record finished industries and tickers, so a crawl
+# that died can be resumed, see journal
+JOURNAL = None
+
+KEYSTATS_PARSER = keystats_parser.KeystatsParser()
+
+
+class IndustryStats(records.Record):
+    __slots__ = ()
+
+    FIELDS = (('sector', 'industry') +
+              tuple('sector_%s' % f for f in INDUSTRY_FIELDS) +
+              tuple('industry_%s' % f for f in INDUSTRY_FIELDS))
+    POSITIONS = records.positions(FIELDS)
+    INTERN = True
+
+
+class Keystats(records.Record):
+    __slots__ = ()
+
+    FIELDS = FUNDAMENTALS_FIELDS
+    POSITIONS = records.positions(FIELDS)
+
+
+# Keystats page labels onto Keystats positions
+KEYSTATS_POSITIONS = dict((label, Keystats.POSITIONS[name])
+                          for label, name in KEY_MAP.iteritems())
+
 
 class DatabaseHandler(object):
-    def __init__(self, host, user, password, database, table,
-                 output_queues=None):
-        self.host = host
-        self.user = user
-        self.password = password
-        self.database = database
+    def __init__(self, storage, table, output_queues=None):
+        self.storage = storage
         self.table = table
 
         if output_queues is None:
@@ -101,108 +222,404 @@ class DatabaseHandler(object):
         self.output_queues = output_queues
 
     def pre_handling(self):
-        self.db = MySQLdb.connect(host=self.host,
-                                  user=self.user,
-                                  passwd=self.password,
-                                  db=self.database)
+        self.db = self.storage.connect()
+        self.create_tickers_table()
+        self.load_ticker_ids()
+
+    def create_tickers_table(self):
+        # A new database, the others are created by the handlers that
+        # write them
+        if self.db.has_table(TICKERS_TABLE):
+            return
+
+        LOG.info('Creating %s', TICKERS_TABLE)
+        self.db.create_table(TICKERS_TABLE,
+                             [('id', self.db.serial),
+                              ('ticker', 'VARCHAR(32) NOT NULL'),
+                              ('sector', 'VARCHAR(255)'),
+                              ('industry', 'VARCHAR(255)'),
+                              ('industry_id', 'INT'),
+                              ('last_seen', self.db.timestamp)],
+                             primary=('id', ), unique=('ticker', ),
+                             keys=[('industry_id', )])
+        self.db.commit()
+
+    def load_ticker_ids(self):
+        self.ticker_ids = dict(self.db.query('SELECT ticker, id FROM %s' %
+                                             TICKERS_TABLE))
+
+    def resolve_ticker_ids(self, tickers):
+        missing = tuple(set(t for t in tickers if t not in self.ticker_ids))
+
+        if missing:
+            self.ticker_ids.update(self.db.query(
+                'SELECT ticker, id FROM %s WHERE ticker IN (%s)' %
+                (TICKERS_TABLE, self.db.params(len(missing))), missing))
+
+        return self.ticker_ids
 
     def message_handler(self, msg):
         for output_queue in self.output_queues:
             if not isinstance(msg, collections.Iterable):
                 msg = [msg]
-            output_queue.push(msg, delay=random.randint(MIN_DELAY,
-                                                        MAX_DELAY))
+            output_queue.push(msg, delay=get_push_delay())
 
     def post_handling(self):
         self.db.close()
 
 
 class TickerHandler(DatabaseHandler):
-    def message_handler(self, tickers):
-        cursor = self.db.cursor()
-        fields = ('1d_price_change', 'market_cap', 'trailing_pe', 'roe_ttm',
-                  'trailing_annual_div_yield', 'debt_to_equity_mrq',
-                  'price_per_book_mrq')
-
-        fields_str = ', '.join(['sector_%s' % f for f in fields] +
-                               ['industry_%s' % f for f in fields])
-        fields_inst_str = ', '.join(['%%(%s)s' % ('sector_%s' % f)
-                                     for f in fields] +
-                                    ['%%(%s)s' % ('industry_%s' % f)
-                                     for f in fields])
-        qry = ' '.join(['INSERT INTO %s' % self.table,
-                        '(ticker, sector, industry, %s)' % fields_str,
-                        'VALUES (%(ticker)s, %(sector)s, %(industry)s,',
-                        '%s)' % fields_inst_str,
-                        'ON DUPLICATE KEY UPDATE',
-                        'last_seen = NOW(),',
-                        'sector = %(sector)s,',
-                        'industry = %(industry)s,',
-                        ', '.join(['%s = %%(%s)s' % (('sector_%s' % f,) * 2)
-                                   for f in fields]) + ',',
-                        ', '.join(['%s = %%(%s)s' % (('industry_%s' % f,) * 2)
-                                   for f in fields])])
-
-        cursor.executemany(qry, tickers)
+    def __init__(self, *args, **kwargs):
+        self.incremental = kwargs.pop('incremental', False)
+        self.freshness = kwargs.pop('freshness', FRESHNESS)
+        self.fundamentals_table = kwargs.pop('fundamentals_table',
+                                             FUNDAMENTALS_TABLE)
+        self.sector_table = kwargs.pop('sector_table', SECTOR_STATS_TABLE)
+        self.industry_table = kwargs.pop('industry_table',
+                                         INDUSTRY_STATS_TABLE)
+        DatabaseHandler.__init__(self, *args, **kwargs)
+
+        self.sector_fields = tuple('sector_%s' % f for f in INDUSTRY_FIELDS)
+        self.industry_fields = (('sector', 'industry') +
+                                tuple('industry_%s' % f
+                                      for f in INDUSTRY_FIELDS))
+
+    def pre_handling(self):
+        DatabaseHandler.pre_handling(self)
+        self.refreshed = {}
+        self.scheduled = 0
+        self.skipped = 0
+        self.moved = 0
+        self.resumed = 0
+        self.snapshot = datetime.date.today()
+        self.sectors = set()
+
+        self.create_stats_tables()
+        self.load_membership()
+
+        if self.incremental:
+            self.load_refreshed()
+
+    def create_stats_tables(self):
+        # One row per sector or industry and snapshot_dt, a recrawl the
+        # same day overwrites it
+        tables = (
+            (self.sector_table,
+             [('sector', 'VARCHAR(255) NOT NULL'),
+              ('snapshot_dt', 'DATE NOT NULL')] +
+             [(f, 'DOUBLE') for f in self.sector_fields],
+             ('sector', 'snapshot_dt'), ()),
+            (self.industry_table,
+             [('industry_id', 'INT NOT NULL'),
+              ('snapshot_dt', 'DATE NOT NULL'),
+              ('sector', 'VARCHAR(255)'),
+              ('industry', 'VARCHAR(255)')] +
+             [(f, 'DOUBLE') for f in self.industry_fields[2:]],
+             ('industry_id', 'snapshot_dt'), [('sector', )]))
+
+        for table, columns, primary, keys in tables:
+            if not self.db.has_table(table):
+                LOG.info('Creating %s', table)
+                self.db.create_table(table, columns, primary=primary,
+                                     keys=keys)
+
+        if not self.db.has_column(self.table, 'industry_id'):
+            LOG.info('Adding industry_id to %s', self.table)
+            self.db.add_column(self.table, 'industry_id', 'INT', key=True)
+
         self.db.commit()
-        cursor.close()
-        DatabaseHandler.message_handler(self, tickers)
+
+    def load_membership(self):
+        self.membership = dict(
+            (row[0], tuple(row[1:])) for row in self.db.query(
+                'SELECT ticker, sector, industry, industry_id FROM %s' %
+                self.table))
+
+    def load_refreshed(self):
+        if not self.db.has_table(self.fundamentals_table):
+            return
+
+        qry = 'SELECT ticker_id, %s, %s FROM %s GROUP BY ticker_id' % (
+            self.db.typed('MAX(refresh_dt)', 'refresh_dt', 'TIMESTAMP'),
+            self.db.typed('MAX(mrq)', 'mrq', 'DATE'),
+            self.fundamentals_table)
+        self.refreshed = dict((ticker_id, (refresh_dt, mrq))
+                              for ticker_id, refresh_dt, mrq
+                              in self.db.query(qry))
+
+    def is_stale(self, ticker_id, now=None):
+        if ticker_id not in self.refreshed:
+            return True
+
+        if now is None:
+            now = datetime.datetime.now()
+
+        refresh_dt, mrq = self.refreshed[ticker_id]
+
+        if refresh_dt is None:
+            return True
+
+        if now - refresh_dt > self.freshness['market']:
+            return True
+
+        if mrq is not None:
+            if not isinstance(mrq, datetime.datetime):
+                mrq = datetime.datetime.combine(mrq, datetime.time())
+
+            filed = (mrq + self.freshness['quarter'] +
+                     self.freshness['filing_lag'])
+            if refresh_dt < filed <= now:
+                return True
+
+        return False
+
+    def write_stats(self, tickers):
+        industries = {}
+        for ticker in tickers:
+            industries.setdefault(ticker.industry_id, ticker.stats)
+
+        sectors = []
+        rows = []
+        for industry_id, stats in industries.iteritems():
+            row = stats.asdict()
+            row.update(industry_id=industry_id, snapshot_dt=self.snapshot)
+            rows.append(row)
+
+            # Every industry page repeats its sector's stats, the first
+            # one seen stands for the sector
+            if row['sector'] not in self.sectors:
+                self.sectors.add(row['sector'])
+                sectors.append(row)
+
+        if sectors:
+            self.db.upsert(self.sector_table, ('sector', 'snapshot_dt'),
+                           ('sector', 'snapshot_dt') + self.sector_fields,
+                           sectors)
+            metrics.inc('db_rows_total', len(sectors),
+                        table=self.sector_table)
+        self.db.upsert(self.industry_table, ('industry_id', 'snapshot_dt'),
+                       ('industry_id', 'snapshot_dt') + self.industry_fields,
+                       rows)
+        metrics.inc('db_rows_total', len(rows), table=self.industry_table)
+
+    def message_handler(self, tickers):
+        stored = tickers
+        moved = []
+        for ticker in tickers:
+            member = (ticker['sector'], ticker['industry'], ticker.industry_id)
+            if self.membership.get(ticker.ticker) != member:
+                moved.append(ticker)
+
+        # Only tickers that are new or moved are written in full, the rest
+        # just get last_seen moved on in one statement
+        seen = tuple(set(t.ticker for t in tickers) -
+                     set(t.ticker for t in moved))
+        with metrics.timer('db_write_seconds', table=self.table):
+            self.write_stats(tickers)
+            if moved:
+                self.db.upsert(self.table, ('ticker', ),
+                               ('ticker', 'sector', 'industry',
+                                'industry_id'),
+                               [t.asdict() for t in moved],
+                               touch='last_seen')
+            if seen:
+                self.db.execute('UPDATE %s SET `last_seen` = %s '
+                                'WHERE ticker IN (%s)' %
+                                (self.table, self.db.now(),
+                                 self.db.params(len(seen))), seen)
+            self.db.commit()
+        metrics.inc('db_rows_total', len(moved), table=self.table)
+
+        for ticker in moved:
+            self.membership[ticker.ticker] = (ticker['sector'],
+                                              ticker['industry'],
+                                              ticker.industry_id)
+        self.moved += len(moved)
+
+        # Hand the ids along so the keystats writer never has to look them up
+        ids = self.resolve_ticker_ids([t['ticker'] for t in tickers])
+        for ticker in tickers:
+            ticker['ticker_id'] = ids.get(ticker['ticker'])
+
+        if JOURNAL is not None:
+            # Resuming, the keystats of these are stored already
+            left = [t for t in tickers
+                    if not JOURNAL.finished(TICKER, t.ticker)]
+            self.resumed += len(tickers) - len(left)
+            tickers = left
+
+        if self.incremental:
+            now = datetime.datetime.now()
+            stale = [t for t in tickers if self.is_stale(t['ticker_id'], now)]
+            self.skipped += len(tickers) - len(stale)
+            tickers = stale
+
+        self.scheduled += len(tickers)
+
+        # An industry page only stays unchanged while the keystats of every
+        # ticker scheduled from it are stored, one that failed is fetched
+        # again on the next crawl with a page cache
+        pages = dict((t.industry_id, []) for t in stored)
+        for ticker in tickers:
+            pages[ticker.industry_id].append(KEYSTATS_URL %
+                                             {'ticker': ticker.ticker})
+        for industry_id, depends in pages.iteritems():
+            commit_pages([INDUSTRY_URL % {'id': industry_id}], depends)
+
+        if tickers:
+            DatabaseHandler.message_handler(self, tickers)
+
+        # Only once the tickers have been handed on, a sharded crawl is
+        # over when no industry is left and a resumed one refetches an
+        # industry until all of the tickers scheduled here are stored
+        complete(INDUSTRY, set(t.industry_id for t in stored),
+                 [t.ticker for t in tickers])
+
+    def post_handling(self):
+        LOG.info('Wrote %s new or moved tickers', self.moved)
+        if self.resumed:
+            LOG.info('Skipped %s tickers stored before resuming',
+                     self.resumed)
+        if self.incremental:
+            LOG.info('Scheduled %s keystats fetches, skipped %s fresh ones',
+                     self.scheduled, self.skipped)
+        DatabaseHandler.post_handling(self)
 
 
 class KeystatsHandler(DatabaseHandler):
-    def message_handler(self, ticker):
-        values = dict((KEY_MAP[k],
-                       v if KEY_MAP[k] not in DATE_MAP else get_date(v))
-                      for k, v in ticker['keystats'].iteritems()
-                      if KEY_MAP.get(k))
-
-        fields = ('10d_avg_vol', '200d_mavg', '3m_avg_vol',
-                  '5y_avg_div_yld', '50d_mavg', '52w_change',
-                  '52w_high', '52w_low', 'beta', 'bk_val_per_share_mrq',
-                  'cur_ratio_mrq', 'dil_eps_ttm', 'div_date', 'ebita_ttm',
-                  'ent_val', 'ent_val_ebita_ttm', 'ent_val_rev_ttm',
-                  'ex_div_date', 'fsc_year_end', 'float',
-                  'fw_ann_div_rate', 'fw_ann_div_yld', 'fw_pe',
-                  'gross_profit_ttm', 'last_split_date',
-                  'last_split_factor', 'levered_free_cash_flow_ttm',
-                  'market_cap', 'mrq', 'net_inc_avl_to_com_ttm',
-                  'op_cash_flow_ttm', 'op_margin_ttm', 'peg_ratio',
-                  'payout_ratio', 'insider_percent', 'inst_percent',
-                  'price_per_book_mrq', 'price_per_sales_ttm',
-                  'prior_m_shares_short', 'profit_margin_ttm',
-                  'qtrly_earnings_growth_yoy', 'qtrly_revenue_growth_yoy',
-                  'roa_ttm', 'roe_ttm', 'revenue_ttm',
-                  'revenue_per_share_ttm', 'sp_52w_change',
-                  'shares_out', 'shares_short', 'short_percent_of_float',
-                  'short_ratio', 'cash_mrq', 'cash_per_share_mrq',
-                  'debt_mrq', 'debt_to_equity_mrq',
-                  'trailing_annual_div_yield', 'trailing_pe')
-
-        fields_str = ', '.join(['`%s`' % f for f in fields])
-        cursor = self.db.cursor()
-        qry = ' '.join(['INSERT INTO %s' % self.table,
-                        '(`ticker_id`, %s)' % fields_str,
-                        '\nSELECT', 'tickers.id,',
-                        ', '.join(['%%(%s)s' % f for f in fields]),
-                        'FROM tickers WHERE',
-                        'ticker = "%s"' % ticker['ticker']])
-
-        cursor.execute(qry, values)
+    def __init__(self, *args, **kwargs):
+        self.batch_size = kwargs.pop('batch_size', BATCH_SIZE)
+        self.flush_interval = kwargs.pop('flush_interval', FLUSH_INTERVAL)
+        self.latest_table = kwargs.pop('latest_table', LATEST_TABLE)
+        DatabaseHandler.__init__(self, *args, **kwargs)
+
+        self.fields = ('ticker_id', ) + FUNDAMENTALS_FIELDS
+        # refresh_dt is passed in rather than NOW(), MySQLdb only batches
+        # a VALUES clause without nested parens
+        self.latest_fields = (('ticker_id', 'ticker', 'sector', 'industry',
+                               'refresh_dt') + FUNDAMENTALS_FIELDS)
+
+    def pre_handling(self):
+        DatabaseHandler.pre_handling(self)
+        self.buffer = []
+        self.last_flush = time.time()
+
+        self.create_table()
+        if self.latest_table:
+            self.create_latest_table()
+
+    def field_columns(self):
+        return [(f, FIELD_TYPES.get(f, 'DOUBLE')) for f in FUNDAMENTALS_FIELDS]
+
+    def create_table(self):
+        if self.db.has_table(self.table):
+            return
+
+        LOG.info('Creating %s', self.table)
+        self.db.create_table(self.table,
+                             [('ticker_id', 'INT NOT NULL'),
+                              ('refresh_dt', self.db.timestamp)] +
+                             self.field_columns(),
+                             keys=[('ticker_id', 'refresh_dt')])
         self.db.commit()
-        cursor.close()
+
+    def create_latest_table(self):
+        if self.db.has_table(self.latest_table):
+            return
+
+        LOG.info('Creating %s from %s', self.latest_table, self.table)
+        # Column types come from the history tables where the engine can,
+        # and the table starts out with the newest row already stored for
+        # each ticker
+        fields = ', '.join(['f.`%s`' % f for f in FUNDAMENTALS_FIELDS])
+        select = ' '.join([
+            'SELECT f.`ticker_id`, t.`ticker`, t.`sector`,',
+            't.`industry`, f.`refresh_dt`, %s' % fields,
+            'FROM %s f' % self.table,
+            'JOIN (SELECT ticker_id, MAX(refresh_dt) AS refresh_dt',
+            'FROM %s GROUP BY ticker_id) m' % self.table,
+            'ON f.ticker_id = m.ticker_id',
+            'AND f.refresh_dt = m.refresh_dt',
+            'JOIN %s t ON t.id = f.ticker_id' % TICKERS_TABLE])
+        columns = ([('ticker_id', 'INT NOT NULL'),
+                    ('ticker', 'VARCHAR(32)'),
+                    ('sector', 'VARCHAR(255)'),
+                    ('industry', 'VARCHAR(255)'),
+                    ('refresh_dt', 'TIMESTAMP')] +
+                   self.field_columns())
+        self.db.create_table_as(self.latest_table, columns, select,
+                                primary=('ticker_id', ), keys=LATEST_INDEXES)
+        self.db.commit()
+
+    def message_handler(self, ticker):
+        keystats = ticker['keystats']
+        if not isinstance(keystats, Keystats):
+            keystats = Keystats.from_items(keystats.iteritems(),
+                                           KEYSTATS_POSITIONS)
+
+        values = keystats.asdict()
+        for name in DATE_MAP:
+            if values[name] is not None:
+                values[name] = get_date(values[name])
+        values['ticker_id'] = ticker.get('ticker_id')
+        values['ticker'] = ticker['ticker']
+        values['sector'] = ticker.get('sector')
+        values['industry'] = ticker.get('industry')
+
+        if values['ticker_id'] is None:
+            values['ticker_id'] = self.ticker_ids.get(ticker['ticker'])
+
+        self.buffer.append((ticker['ticker'], values))
+
+        if (len(self.buffer) >= self.batch_size or
+                time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
         DatabaseHandler.message_handler(self, ticker)
 
+    def flush(self):
+        self.last_flush = time.time()
 
-def get_date(s):
-    if not isinstance(s, basestring):
-        return s
-    time_tpl = pdt.Calendar().parse(s)[0][:7]
-    return datetime.datetime(*time_tpl)
+        if not self.buffer:
+            return
+
+        buffer, self.buffer = self.buffer, []
+        ids = self.resolve_ticker_ids([ticker for ticker, values in buffer
+                                       if values['ticker_id'] is None])
+
+        rows = []
+        for ticker, values in buffer:
+            if values['ticker_id'] is None:
+                values['ticker_id'] = ids.get(ticker)
+            if values['ticker_id'] is not None:
+                rows.append(values)
+
+        if rows:
+            with metrics.timer('db_write_seconds', table=self.table):
+                self.db.insert(self.table, self.fields, rows)
 
+                if self.latest_table:
+                    # One refresh_dt for the whole batch, like a single NOW()
+                    now = datetime.datetime.now()
+                    for values in rows:
+                        values['refresh_dt'] = now
+                    self.db.upsert(self.latest_table, ('ticker_id', ),
+                                   self.latest_fields, rows)
 
-def pairwise(iterable):
-    args = [iter(iterable)] * 2
-    return itertools.izip_longest(fillvalue=None, *args)
+                self.db.commit()
+            metrics.inc('db_rows_total', len(rows), table=self.table)
+
+        commit_pages(KEYSTATS_URL % {'ticker': ticker}
+                     for ticker, values in buffer)
+        complete(TICKER, [ticker for ticker, values in buffer])
+
+    def post_handling(self):
+        self.flush()
+        DatabaseHandler.post_handling(self)
+
+
+def get_date(s):
+    return dates.get_date(s)
 
 
 def numify(value):
@@ -233,29 +650,124 @@ def numify(value):
     return value
 
 
-def get_industry_ids():
-    r = requests.get(SECTOR_URL)
+def get_push_delay():
+    if RATE_LIMITER is not None:
+        return 0
+    return random.randint(MIN_DELAY, MAX_DELAY)
+
+
+def get_retry_delay():
+    # The rate limited session already retries each request with backoff
+    if RATE_LIMITER is not None:
+        return 0
+    return random.randint(MIN_RETRY_DELAY, MAX_RETRY_DELAY)
+
+
+def get_page(url, session=None, **kwargs):
+    if session is None:
+        session = SESSION
+
+    if metrics.REGISTRY is None:
+        return _get_page(url, session, **kwargs)
+
+    host = urlparse.urlsplit(url).netloc
+    start = time.time()
+    try:
+        r = _get_page(url, session, **kwargs)
+    except Exception:
+        metrics.inc('http_errors_total', host=host)
+        raise
+    finally:
+        metrics.observe('http_request_seconds', time.time() - start,
+                        host=host)
+
+    metrics.inc('http_responses_total', host=host, status=r.status_code)
+    if getattr(r, 'from_cache', False):
+        metrics.inc('page_cache_hits_total', host=host)
+    elif 'Content-Length' in r.headers:
+        metrics.inc('http_bytes_total', int(r.headers['Content-Length']),
+                    host=host)
+    elif not kwargs.get('stream'):
+        metrics.inc('http_bytes_total', len(r.content), host=host)
+
+    return r
+
+
+def _get_page(url, session, **kwargs):
+    if PAGE_CACHE is not None:
+        return PAGE_CACHE.get(url, session, **kwargs)
+
+    return session.get(url, **kwargs)
+
+
+def commit_pages(urls, depends=()):
+    if PAGE_CACHE is None:
+        return
+
+    for url in urls:
+        PAGE_CACHE.commit(url, depends)
+
+
+def complete(kind, keys, scheduled=None):
+    if WORK_STORE is not None:
+        WORK_STORE.done(kind, keys)
+    if JOURNAL is not None:
+        JOURNAL.record(kind, keys, scheduled)
+
+
+def give_up(msg):
+    # A message a local stage failed on for good
+    if WORK_STORE is None:
+        return
+
+    if isinstance(msg, (int, long)):
+        WORK_STORE.fail(INDUSTRY, [msg])
+    elif isinstance(msg, list):
+        WORK_STORE.fail(INDUSTRY, set(t['industry_id'] for t in msg))
+    else:
+        WORK_STORE.fail(TICKER, [msg['ticker']])
+
+
+def unchanged(r):
+    # The page is byte for byte what was stored last time, nothing to do
+    return getattr(r, 'unchanged', False)
+
+
+def get_industry_ids(session=None):
+    r = get_page(SECTOR_URL, session)
     tree = etree.HTML(r.text)
     xpath = '//table[@width=\"100%\"]//td[@bgcolor=\"ffffee\"]/a'
     return [int(l.get('href').strip('conameu.html'))
             for l in tree.xpath(xpath)]
 
 
-def get_tickers_for_industry(industry_id):
-    r = requests.get(INDUSTRY_URL % {'id': industry_id})
-    tree = etree.HTML(r.text)
-    tickers = []
-    fields = ('1d_price_change', 'market_cap', 'trailing_pe', 'roe_ttm',
-              'trailing_annual_div_yield', 'debt_to_equity_mrq',
-              'price_per_book_mrq')
+def get_tickers_for_industry(industry_id, session=None):
+    r = get_page(INDUSTRY_URL % {'id': industry_id}, session)
+    if unchanged(r):
+        complete(INDUSTRY, [industry_id])
+        return
+
+    with metrics.timer('parse_seconds', page='industry'):
+        tickers = parse_industry(r.text, industry_id)
+
+    # NOTE(jkoelker) If no tickers are found return None so it won't be
+    #                pushed into a queue
+    if not tickers:
+        complete(INDUSTRY, [industry_id])
+        return
+
+    return tickers
+
 
-    def get_stats(prefix, td):
-        ret = {}
-        for i, cell in enumerate(td.getparent().xpath('.//td')[1:-2]):
-            key = '%s_%s' % (prefix, fields[i])
-            ret[key] = numify(cell.xpath('.//font')[0].text)
+def parse_industry(text, industry_id):
+    tree = etree.HTML(text)
+    tickers = []
 
-        return ret
+    def get_stats(td):
+        cells = td.getparent().xpath('.//td')[1:-2]
+        values = [numify(cell.xpath('.//font')[0].text) for cell in cells]
+        values.extend([None] * (len(INDUSTRY_FIELDS) - len(values)))
+        return values[:len(INDUSTRY_FIELDS)]
 
     xpath = '//table[@width=\"100%\"]//td[@bgcolor=\"ffffee\"]'
     cells = tree.xpath(xpath)
@@ -268,8 +780,9 @@ def get_tickers_for_industry(industry_id):
     industry = industry.replace('\n', ' ')
     industry = industry.strip().strip('(').strip()
 
-    sector_data = get_stats('sector', sector_td)
-    industry_data = get_stats('industry', industry_td)
+    # Every ticker of the industry shares the one stats record
+    stats = IndustryStats([sector, industry] + get_stats(sector_td) +
+                          get_stats(industry_td))
 
     for td in cells[2:]:
         links = td.xpath('.//a')
@@ -280,67 +793,34 @@ def get_tickers_for_industry(industry_id):
         if '.' in ticker:
             continue
 
-        data = {'sector': sector,
-                'sector_data': sector_data,
-                'industry': industry,
-                'industry_data': industry_data,
-                'ticker': ticker}
-        data.update(sector_data)
-        data.update(industry_data)
-        tickers.append(data)
-
-    # NOTE(jkoelker) If no tickers are found return None so it won't be
-    #                pushed into a queue
-    if not tickers:
-        return
+        tickers.append(records.Ticker(ticker, industry_id, stats))
 
     return tickers
 
 
-def get_keystats(ticker):
-    r = requests.get(KEYSTATS_URL % ticker)
-
-    tree = etree.HTML(r.text)
-    keystats = {}
-
-    xpath = ('//table[@class="yfnc_datamodoutline1"]/tr/td/table/tr'
-             '/td[@class="yfnc_tabledata1" or @class="yfnc_tablehead1"]')
-
-    for name, value in pairwise(tree.xpath(xpath)):
-        if len(value) > 0:
-            value = value.xpath('.//span')[0]
-
-        name = name.text.strip()
-        name = name.replace(':', '')
-        name = name.replace('\n', ' ')
-        name = name.replace('%', 'Percentage')
+def get_keystats(ticker, session=None):
+    url = KEYSTATS_URL % ticker
 
-        if '(' in name:
-            attrs = name.strip(')').split('(')
-            if '(ttm)' in name or '(mrq)' in name or '(yoy)' in name:
-                name = name
-
-            elif '3 month' in name:
-                name = '3 month ' + attrs[0]
-
-            elif '10 day' in name:
-                name = '10 day ' + attrs[0]
-
-            elif 'prior month' in name:
-                name = 'Prior Month ' + attrs[0]
-
-            else:
-                name = attrs[0]
-
-        name = str(name.strip())
-        value = value.text.strip()
-        value = numify(value)
+    r = get_page(url, session)
+    if unchanged(r):
+        r.close()
+        complete(TICKER, [ticker['ticker']])
+        return
 
-        keystats[name] = value
+    try:
+        with metrics.timer('parse_seconds', page='keystats'):
+            stats = KEYSTATS_PARSER.parse(r.text)
+            keystats = Keystats.from_items(((name, numify(value))
+                                            for name, value in stats),
+                                           KEYSTATS_POSITIONS)
+    finally:
+        r.close()
 
     # NOTE(jkoelker) If no keystats are found return None so it won't be
     #                pushed into a queue
     if not keystats:
+        commit_pages([url])
+        complete(TICKER, [ticker['ticker']])
         return
 
     ticker['keystats'] = keystats
@@ -349,57 +829,322 @@ def get_keystats(ticker):
 
 
 def main():
+    global PAGE_CACHE
+    global RATE_LIMITER
+    global SESSION
+    global WORK_STORE
+    global JOURNAL
+
     parser = argparse.ArgumentParser(description='Scrape yahoo for tickers',
                                      add_help=False)
     parser.add_argument('-h', '--host',
-                        required=True,
                         help='MySQL host')
     parser.add_argument('-u', '--user',
-                        required=True,
                         help='MySQL User')
     parser.add_argument('-p', '--password',
-                        required=True,
                         help='MySQL password')
     parser.add_argument('database',
-                        help='Database to store tickers in')
+                        help='Database to store tickers in, the file for '
+                             'sqlite')
+    parser.add_argument('--engine',
+                        choices=storage.ENGINES,
+                        default=storage.MYSQL,
+                        help='Store in MySQL, or in a sqlite file for '
+                             'local runs')
+    parser.add_argument('--batch-size',
+                        default=BATCH_SIZE,
+                        type=int,
+                        help='Keystats rows to buffer before writing them')
+    parser.add_argument('--bulk-rows',
+                        default=storage.BULK_ROWS,
+                        type=int,
+                        help='Write batches of at least this many rows to '
+                             'MySQL with LOAD DATA LOCAL INFILE, 0 never '
+                             'does')
+    parser.add_argument('--local',
+                        action='store_true',
+                        help='Run the queue graph on this machine')
+    parser.add_argument('--workers',
+                        action='append', default=[], metavar='QUEUE=COUNT',
+                        help='Number of local workers for a queue')
+    parser.add_argument('--worker-kind',
+                        choices=(pipeline.THREAD, pipeline.PROCESS),
+                        default=pipeline.THREAD,
+                        help='Run local workers as threads or processes')
+    parser.add_argument('--queue-size',
+                        default=pipeline.QUEUE_SIZE,
+                        type=int,
+                        help='Maximum messages waiting in a local queue')
+    parser.add_argument('--rate',
+                        type=float,
+                        help='Starting requests per second for each host, '
+                             'adapted to how the host responds (local runs)')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='Only fetch keystats for tickers whose stored '
+                             'fundamentals are stale')
+    parser.add_argument('--cache-dir',
+                        help='Keep fetched pages here and skip pages that '
+                             'have not changed since they were stored '
+                             '(local runs)')
+    parser.add_argument('--cache-size',
+                        default=pagecache.MAX_BYTES,
+                        type=int,
+                        help='Maximum bytes of pages to keep in the cache')
+    parser.add_argument('--record',
+                        metavar='ARCHIVE',
+                        help='Write every fetched page to this archive '
+                             '(local runs with thread workers)')
+    parser.add_argument('--replay',
+                        metavar='ARCHIVE',
+                        help='Fetch pages from a recorded archive, or the '
+                             'url of an archive.py server, instead of '
+                             'yahoo (local runs)')
+    parser.add_argument('--replay-latency',
+                        default=0,
+                        type=float,
+                        help='Seconds the replayed hosts take to answer')
+    parser.add_argument('--replay-errors',
+                        default=0,
+                        type=float,
+                        help='Fraction of replayed requests that fail with '
+                             'a 503')
+    parser.add_argument('--shard-store',
+                        metavar='PATH',
+                        help='Share the crawl with the other workers using '
+                             'this sqlite file, one file per crawl (local '
+                             'runs)')
+    parser.add_argument('--shards',
+                        default=shards.SHARDS,
+                        type=int,
+                        help='Shards to split industries and tickers into '
+                             'when the shard store is created')
+    parser.add_argument('--worker-name',
+                        help='Name of this worker in the shard store '
+                             '(default: host-pid)')
+    parser.add_argument('--coordinator',
+                        action='store_true',
+                        help='Seed the shard store with the industries and '
+                             'rebalance shards of stalled workers, one '
+                             'worker per crawl does this')
+    parser.add_argument('--stall',
+                        default=shards.STALL,
+                        type=float,
+                        help='Seconds a worker may go without progress '
+                             'before its shards are handed out again')
+    parser.add_argument('--journal',
+                        metavar='PATH',
+                        help='Record every finished industry and ticker '
+                             'in this file (local runs)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Skip the industries and tickers the journal '
+                             'has as finished instead of starting over')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='Serve per-stage metrics for Prometheus on this '
+                             'port (local runs)')
+    parser.add_argument('--metrics-file',
+                        help='Write per-stage metrics as json to this file '
+                             'while running and when done (local runs)')
+    parser.add_argument('--metrics-interval',
+                        default=metrics.INTERVAL,
+                        type=float,
+                        help='Seconds between writes of --metrics-file')
     parser.add_argument('--help',
                         action='help', default=argparse.SUPPRESS,
                         help='show this help message and exit')
     args = parser.parse_args()
-    db_args = (args.host, args.user, args.password, args.database)
-
-    input_q = cloud.queue.get('tickers-input')
-    ticker_q = cloud.queue.get('tickers-tickers')
-    fetch_q = cloud.queue.get('tickers-fetch-keystats')
-    keystats_q = cloud.queue.get('tickers-keystats')
 
-    input_q.attach(get_tickers_for_industry, output_queues=[ticker_q],
+    if args.engine == storage.MYSQL and not (args.host and args.user and
+                                             args.password):
+        parser.error('MySQL needs --host, --user and --password')
+
+    if args.engine == storage.SQLITE and not args.local:
+        parser.error('--engine sqlite needs --local')
+
+    if (args.metrics_port or args.metrics_file) and not args.local:
+        parser.error('--metrics-port and --metrics-file need --local')
+
+    if (args.record or args.replay) and not args.local:
+        parser.error('--record and --replay need --local')
+
+    if args.record and args.worker_kind != pipeline.THREAD:
+        parser.error('--record needs thread workers')
+
+    if args.shard_store and not args.local:
+        parser.error('--shard-store needs --local')
+
+    if args.coordinator and not args.shard_store:
+        parser.error('--coordinator needs --shard-store')
+
+    if args.journal and not args.local:
+        parser.error('--journal needs --local')
+
+    if args.resume and not args.journal:
+        parser.error('--resume needs --journal')
+
+    recorder = None
+    store = storage.backend(args.engine, args.database, args.host,
+                            args.user, args.password, args.bulk_rows)
+
+    if args.local:
+        logging.basicConfig(level=logging.INFO)
+
+        if args.metrics_port or args.metrics_file:
+            metrics.REGISTRY = metrics.Registry()
+
+        # Recording and replaying happen under the pooling and rate
+        # limiting, so both still act on the original hosts
+        session = fetcher.make_session()
+        if args.replay:
+            base_url = args.replay
+            if not base_url.startswith('http'):
+                server = archive.ReplayServer(
+                    archive.Archive(args.replay),
+                    latency=args.replay_latency,
+                    error_rate=args.replay_errors)
+                server.start()
+                base_url = server.url
+            session = archive.ReplaySession(session, base_url)
+        if args.record:
+            recorder = archive.Recorder(args.record)
+            session = archive.RecordingSession(session, recorder)
+        SESSION = fetcher.PooledSession(session=session)
+
+        if args.rate:
+            hosts = [urlparse.urlsplit(url).netloc
+                     for url in (SECTOR_URL, INDUSTRY_URL, KEYSTATS_URL)]
+            RATE_LIMITER = ratelimit.AdaptiveRateLimiter(hosts=hosts,
+                                                         rate=args.rate)
+            SESSION = ratelimit.RateLimitedSession(
+                SESSION, RATE_LIMITER,
+                retry_on=[requests.RequestException],
+                max_retries=MAX_RETRIES)
+
+        if args.cache_dir:
+            PAGE_CACHE = pagecache.PageCache(args.cache_dir,
+                                             ttls=CACHE_TTLS,
+                                             max_bytes=args.cache_size)
+        workers = dict((name, int(count)) for name, count in
+                       (w.split('=', 1) for w in args.workers))
+        queues = pipeline.Pipeline(maxsize=args.queue_size,
+                                   workers=workers,
+                                   kind=args.worker_kind)
+    else:
+        queues = cloud.queue
+
+    input_q = queues.get('tickers-input')
+    ticker_q = queues.get('tickers-tickers')
+    fetch_q = queues.get('tickers-fetch-keystats')
+    keystats_q = queues.get('tickers-keystats')
+
+    # Tickers of a sharded crawl go through the store to whichever worker
+    # owns their shard
+    ticker_outputs = [fetch_q]
+    local_kwargs = {}
+
+    if args.local:
+        local_kwargs['on_failure'] = give_up
+
+    if args.shard_store:
+        WORK_STORE = shards.WorkStore(args.shard_store, args.shards,
+                                      args.worker_name, args.stall)
+        ticker_outputs = [shards.StoreQueue(WORK_STORE, TICKER,
+                                            operator.itemgetter('ticker'))]
+
+    if args.journal:
+        JOURNAL = journal.Journal(args.journal, resume=args.resume)
+
+    if metrics.REGISTRY is not None:
+        for q in (input_q, ticker_q, fetch_q, keystats_q):
+            metrics.REGISTRY.gauge('queue_depth', q.qsize, queue=q.name)
+
+        if args.metrics_port:
+            metrics.serve(metrics.REGISTRY, args.metrics_port)
+        if args.metrics_file:
+            metrics.dump_periodically(metrics.REGISTRY, args.metrics_file,
+                                      args.metrics_interval)
+
+    input_q.attach(metrics.instrument(get_tickers_for_industry,
+                                      input_q.name),
+                   output_queues=[ticker_q],
                    readers_per_job=2, max_parallel_jobs=4,
                    retry_on=[requests.RequestException],
-                   retry_delay=random.randint(MIN_RETRY_DELAY,
-                                              MAX_RETRY_DELAY),
+                   retry_delay=get_retry_delay(),
                    max_retries=MAX_RETRIES,
-                   _env='investing', _type='s1')
+                   _env='investing', _type='s1', **local_kwargs)
 
-    ticker_q.attach(TickerHandler(*db_args, table='tickers',
-                                  output_queues=[fetch_q]),
-                    readers_per_job=2, max_parallel_jobs=1)
+    ticker_q.attach(metrics.instrument(
+                        TickerHandler(store, table=TICKERS_TABLE,
+                                      output_queues=ticker_outputs,
+                                      incremental=args.incremental),
+                        ticker_q.name),
+                    readers_per_job=2, max_parallel_jobs=1, **local_kwargs)
 
-    fetch_q.attach(get_keystats, output_queues=[keystats_q],
+    fetch_q.attach(metrics.instrument(get_keystats, fetch_q.name),
+                   output_queues=[keystats_q],
                    readers_per_job=2, max_parallel_jobs=10,
                    retry_on=[requests.RequestException],
-                   retry_delay=random.randint(MIN_RETRY_DELAY,
-                                              MAX_RETRY_DELAY),
+                   retry_delay=get_retry_delay(),
                    max_retries=MAX_RETRIES,
-                   _env='investing', _type='s1')
+                   _env='investing', _type='s1', **local_kwargs)
 
-    keystats_q.attach(KeystatsHandler(*db_args, table='fundamentals'),
+    keystats_q.attach(metrics.instrument(
+                          KeystatsHandler(store, table=FUNDAMENTALS_TABLE,
+                                          batch_size=args.batch_size),
+                          keystats_q.name),
                       readers_per_job=2, max_parallel_jobs=1,
-                      _env='investing', )
-
-    for industry_id in get_industry_ids():
-        input_q.push([industry_id], delay=random.randint(MIN_DELAY,
-                                                         MAX_DELAY))
+                      _env='investing', **local_kwargs)
+
+    if WORK_STORE is None or args.coordinator:
+        industry_ids = get_industry_ids()
+        if JOURNAL is not None:
+            left = [i for i in industry_ids
+                    if not JOURNAL.finished(INDUSTRY, i, TICKER)]
+            LOG.info('Skipping %s finished industries',
+                     len(industry_ids) - len(left))
+            industry_ids = left
+
+    coordinator = None
+    try:
+        if WORK_STORE is not None:
+            if args.coordinator:
+                WORK_STORE.seed(INDUSTRY, [(industry_id, industry_id)
+                                           for industry_id in industry_ids])
+                coordinator = shards.Coordinator(WORK_STORE)
+                coordinator.start()
+
+            others = (TICKER, ) if args.coordinator else ()
+            shards.Feeder(WORK_STORE,
+                          [(INDUSTRY, input_q), (TICKER, fetch_q)],
+                          producing=(INDUSTRY, ), others=others).run()
+        else:
+            for industry_id in industry_ids:
+                input_q.push([industry_id], delay=get_push_delay())
+
+        if args.local:
+            stats = queues.join()
+    finally:
+        # The coordinator's thread is stopped before the store goes away
+        # under it
+        if coordinator is not None:
+            coordinator.stop()
+        if WORK_STORE is not None:
+            WORK_STORE.release()
+
+    if args.local:
+        if WORK_STORE is not None:
+            stats['shards'] = WORK_STORE.counts()
+        if JOURNAL is not None:
+            JOURNAL.close()
+        if recorder is not None:
+            recorder.close()
+        if RATE_LIMITER is not None:
+            stats['rates'] = RATE_LIMITER.rates()
+        if args.metrics_file:
+            metrics.dump(metrics.REGISTRY, args.metrics_file)
+        json.dump(stats, sys.stdout, indent=2, sort_keys=True)
 
     return 0
 
@@ -407,6 +1152,8 @@ def main():
 if __name__ == '__main__':
     try:
         ret = main()
-    except:
+    except Exception:
+        logging.basicConfig()
+        LOG.exception('Crawl failed')
         ret = 69
     sys.exit(ret)
@@ -0,0 +1,69 @@
+import threading
+import time
+import urlparse
+
+import requests
+
+from requests import adapters
+
+import metrics
+
+
+POOL_HOSTS = 4
+POOL_SIZE = 20
+PER_HOST = 10
+
+
+def make_session(pool_size=POOL_SIZE, pool_hosts=POOL_HOSTS):
+    session = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_connections=pool_hosts,
+                                   pool_maxsize=pool_size,
+                                   pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def call_with_retries(func, args=(), kwargs=None, retry_on=None,
+                      max_retries=0, retry_delay=0):
+    if kwargs is None:
+        kwargs = {}
+
+    retry_on = tuple(retry_on or ())
+    attempt = 0
+
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except retry_on:
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            metrics.inc('retries_total',
+                        call=getattr(func, '__name__', 'call'))
+            time.sleep(retry_delay)
+
+
+class PooledSession(object):
+    def __init__(self, pool_size=POOL_SIZE, per_host=PER_HOST, session=None):
+        if session is None:
+            session = make_session(pool_size)
+
+        self.session = session
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _slot(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def get(self, url, **kwargs):
+        with self._slot(url):
+            return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Append-only record of finished work, one json line per key:
+# [kind, key] or [kind, key, scheduled] where scheduled are the keys the
+# work handed on. Every line is written with one write() and synced, so a
+# crash loses at most the line being written and a torn last line is
+# skipped when the journal is read back.
+class Journal(object):
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        if resume and os.path.exists(path):
+            self.load()
+        else:
+            flags |= os.O_TRUNC
+        self._fd = os.open(path, flags, 0o644)
+
+        # Whatever follows a torn line starts on a line of its own
+        if resume and os.fstat(self._fd).st_size:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    os.write(self._fd, '\n')
+
+    def load(self):
+        lines = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    self._add(*json.loads(line))
+                except (TypeError, ValueError):
+                    LOG.warning('Skipping torn line %r in %s', line,
+                                self.path)
+                    continue
+                lines += 1
+        LOG.info('Read %s finished entries from %s', lines, self.path)
+
+    def _add(self, kind, key, scheduled=None):
+        self.entries.setdefault(kind, {})[key] = scheduled
+
+    def record(self, kind, keys, scheduled=None):
+        keys = list(keys)
+        if not keys:
+            return
+
+        if scheduled is not None:
+            scheduled = list(scheduled)
+            lines = [json.dumps([kind, key, scheduled]) for key in keys]
+        else:
+            lines = [json.dumps([kind, key]) for key in keys]
+
+        with self._lock:
+            os.write(self._fd, '\n'.join(lines) + '\n')
+            os.fsync(self._fd)
+            for key in keys:
+                self._add(kind, key, scheduled)
+
+    def finished(self, kind, key, child=None):
+        # With child set, the keys of that kind the work scheduled have to
+        # be finished as well
+        entries = self.entries.get(kind, {})
+        if key not in entries:
+            return False
+        if child is None:
+            return True
+        return all(self.finished(child, k) for k in entries[key] or ())
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
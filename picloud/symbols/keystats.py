@@ -0,0 +1,63 @@
+import itertools
+
+from lxml import etree
+
+
+STATS_TABLE = 'yfnc_datamodoutline1'
+CELLS_XPATH = etree.XPath('//table[@class="%s"]/tr/td/table/tr'
+                          '/td[@class="yfnc_tabledata1" or '
+                          '@class="yfnc_tablehead1"]' % STATS_TABLE)
+SPAN_XPATH = etree.XPath('.//span')
+
+
+def pairwise(iterable):
+    args = [iter(iterable)] * 2
+    return itertools.izip_longest(fillvalue=None, *args)
+
+
+def normalize_label(name):
+    name = name.strip()
+    name = name.replace(':', '')
+    name = name.replace('\n', ' ')
+    name = name.replace('%', 'Percentage')
+
+    if '(' in name:
+        attrs = name.strip(')').split('(')
+        if '(ttm)' in name or '(mrq)' in name or '(yoy)' in name:
+            name = name
+
+        elif '3 month' in name:
+            name = '3 month ' + attrs[0]
+
+        elif '10 day' in name:
+            name = '10 day ' + attrs[0]
+
+        elif 'prior month' in name:
+            name = 'Prior Month ' + attrs[0]
+
+        else:
+            name = attrs[0]
+
+    return str(name.strip())
+
+
+class KeystatsParser(object):
+    def __init__(self):
+        self.labels = {}
+
+    def label(self, raw):
+        try:
+            return self.labels[raw]
+        except KeyError:
+            name = self.labels[raw] = normalize_label(raw)
+            return name
+
+    def _stats(self, cells):
+        for name, value in pairwise(cells):
+            if len(value) > 0:
+                value = SPAN_XPATH(value)[0]
+
+            yield self.label(name.text), value.text.strip()
+
+    def parse(self, text):
+        return self._stats(CELLS_XPATH(etree.HTML(text)))
@@ -0,0 +1,282 @@
+import bisect
+import BaseHTTPServer
+import contextlib
+import copy
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 60.0, float('inf'))
+INTERVAL = 10
+
+# Set to a Registry to record metrics. Left as None every helper below
+# returns straight away, so instrumented code costs a global lookup.
+REGISTRY = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.iteritems()))
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # One count per bucket, then the sum of all values
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * len(self.buckets) + [0.0]
+            hist[i] += 1
+            hist[-1] += value
+
+    def gauge(self, name, func, **labels):
+        # func is called whenever the registry is read
+        with self._lock:
+            self.gauges[_key(name, labels)] = func
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            counters = self.counters.items()
+            histograms = [(key, list(hist))
+                          for key, hist in self.histograms.iteritems()]
+            gauges = self.gauges.items()
+
+        values = []
+        for key, func in gauges:
+            try:
+                values.append((key, func()))
+            except Exception:
+                LOG.debug('Gauge %s failed', key[0], exc_info=True)
+
+        return {'counters': counters,
+                'histograms': histograms,
+                'gauges': values}
+
+    def merge(self, snapshot):
+        with self._lock:
+            for key, value in snapshot['counters']:
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, hist in snapshot['histograms']:
+                mine = self.histograms.setdefault(key, [0] * len(hist))
+                for i, value in enumerate(hist):
+                    mine[i] += value
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        for (name, labels), value in sorted(snapshot['counters']):
+            lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+        for (name, labels), value in sorted(snapshot['gauges']):
+            lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+        for (name, labels), hist in sorted(snapshot['histograms']):
+            total = 0
+            for bound, count in zip(self.buckets, hist):
+                total += count
+                lines.append('%s_bucket%s %d' %
+                             (name, _labels(labels, [('le', _number(bound))]),
+                              total))
+            lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                          _number(hist[-1])))
+            lines.append('%s_count%s %d' % (name, _labels(labels), total))
+
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        snapshot = self.snapshot()
+
+        def entries(items, kind):
+            return [dict(labels, name=name, **kind(value))
+                    for (name, labels), value in sorted(items)]
+
+        def histogram(hist):
+            count = sum(hist[:-1])
+            return {'count': count,
+                    'sum': hist[-1],
+                    'mean': hist[-1] / count if count else None,
+                    'buckets': dict((_number(b), c) for b, c
+                                    in zip(self.buckets, hist))}
+
+        return {'time': time.time(),
+                'pid': os.getpid(),
+                'counters': entries(snapshot['counters'],
+                                    lambda v: {'value': v}),
+                'gauges': entries(snapshot['gauges'],
+                                  lambda v: {'value': v}),
+                'histograms': entries(snapshot['histograms'], histogram)}
+
+
+def inc(name, value=1, **labels):
+    if REGISTRY is not None:
+        REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if REGISTRY is not None:
+        REGISTRY.observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def _timer(registry, name, labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.time() - start, **labels)
+
+
+class _NoopTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NOOP = _NoopTimer()
+
+
+def timer(name, **labels):
+    if REGISTRY is None:
+        return _NOOP
+    return _timer(REGISTRY, name, labels)
+
+
+class InstrumentedHandler(object):
+    def __init__(self, handler, stage):
+        self.handler = handler
+        self.stage = stage
+
+    def __copy__(self):
+        # Workers each get their own copy of the wrapped handler
+        return InstrumentedHandler(copy.copy(self.handler), self.stage)
+
+    def pre_handling(self):
+        if hasattr(self.handler, 'pre_handling'):
+            self.handler.pre_handling()
+
+    def message_handler(self, msg):
+        return _call(self.handler.message_handler, self.stage, msg)
+
+    def post_handling(self):
+        if hasattr(self.handler, 'post_handling'):
+            self.handler.post_handling()
+
+
+def _call(func, stage, msg):
+    start = time.time()
+    try:
+        result = func(msg)
+    except Exception:
+        inc('stage_errors_total', stage=stage)
+        raise
+    finally:
+        observe('stage_seconds', time.time() - start, stage=stage)
+    inc('stage_messages_total', stage=stage)
+    return result
+
+
+# Wraps a stage function or handler to count and time every message.
+# Returns it untouched while metrics are disabled.
+def instrument(handler, stage):
+    if REGISTRY is None:
+        return handler
+
+    if hasattr(handler, 'message_handler'):
+        return InstrumentedHandler(handler, stage)
+
+    @functools.wraps(handler)
+    def wrapper(msg):
+        return _call(handler, stage, msg)
+    return wrapper
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        LOG.debug(fmt, *args)
+
+
+def serve(registry, port, host=''):
+    server = BaseHTTPServer.HTTPServer((host, port), _Handler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def dump(registry, path):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(registry.json(), f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def dump_periodically(registry, path, interval=INTERVAL):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(registry, path)
+            except Exception:
+                LOG.exception('Failed writing metrics to %s', path)
+
+    thread = threading.Thread(target=run, name='metrics-dump')
+    thread.daemon = True
+    thread.start()
+    return thread
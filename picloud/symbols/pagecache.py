@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+
+
+LOG = logging.getLogger(__name__)
+
+MAX_BYTES = 512 * 1024 * 1024
+CHUNK_SIZE = 16384
+
+
+def url_pattern(template):
+    # Turn a '%(name)s' style url template into a regex matching its urls
+    parts = re.split(r'%\(\w+\)s', template)
+    return re.compile('^%s$' % '.+'.join(re.escape(p) for p in parts))
+
+
+def _write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+class CachedResponse(object):
+    def __init__(self, url, content, encoding=None, headers=None,
+                 status_code=200, unchanged=False, from_cache=False):
+        self.url = url
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self.headers = headers or {}
+        self.status_code = status_code
+        self.unchanged = unchanged
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        for i in xrange(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Content addressed page store. Bodies live under objects/ named by their
+# sha1, each url has a small json record under urls/ with its validators,
+# the digest it last fetched and the digest last committed by whoever
+# consumed the page. A page is unchanged when the two digests match and
+# every page it was committed depending on is unchanged as well.
+class PageCache(object):
+    def __init__(self, directory, ttls=None, default_ttl=0,
+                 max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.ttls = ttls or []
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        for sub in ('objects', 'urls'):
+            path = os.path.join(directory, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self.size = sum(os.path.getsize(p) for p in self._objects())
+
+    def _objects(self):
+        path = os.path.join(self.directory, 'objects')
+        return [os.path.join(path, name) for name in os.listdir(path)]
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    def _meta_path(self, url):
+        return os.path.join(self.directory, 'urls',
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.match(url):
+                return ttl
+        return self.default_ttl
+
+    def meta(self, url):
+        try:
+            with open(self._meta_path(url)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_meta(self, url, meta):
+        _write(self._meta_path(url), json.dumps(meta))
+
+    def _body(self, meta):
+        if not meta.get('digest'):
+            return
+        try:
+            with open(self._object_path(meta['digest']), 'rb') as f:
+                return f.read()
+        except IOError:
+            return
+
+    def _response(self, url, meta, body, from_cache):
+        return CachedResponse(url, body,
+                              encoding=meta.get('encoding'),
+                              unchanged=self.committed(url, meta),
+                              from_cache=from_cache)
+
+    def get(self, url, session=None, **kwargs):
+        if session is None:
+            session = requests
+
+        # The whole body is read into the cache anyway
+        kwargs.pop('stream', None)
+
+        now = time.time()
+        meta = self.meta(url)
+        body = self._body(meta)
+
+        if body is not None and now - meta.get('fetched', 0) < self.ttl(url):
+            meta['used'] = now
+            self._save_meta(url, meta)
+            return self._response(url, meta, body, True)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if body is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        r = session.get(url, headers=headers, **kwargs)
+
+        if r.status_code == 304 and body is not None:
+            meta['fetched'] = meta['used'] = now
+            self._save_meta(url, meta)
+            return self._response(url, meta, body, True)
+
+        if r.status_code != 200:
+            return r
+
+        body = r.content
+        digest = hashlib.sha1(body).hexdigest()
+
+        if not os.path.exists(self._object_path(digest)):
+            _write(self._object_path(digest), body)
+            with self._lock:
+                self.size += len(body)
+
+        meta.update({'url': url,
+                     'digest': digest,
+                     'encoding': r.encoding,
+                     'etag': r.headers.get('ETag'),
+                     'last_modified': r.headers.get('Last-Modified'),
+                     'fetched': now,
+                     'used': now})
+        self._save_meta(url, meta)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+        return self._response(url, meta, body, False)
+
+    def committed(self, url, meta=None):
+        if meta is None:
+            meta = self.meta(url)
+        if not meta.get('digest') or meta['digest'] != meta.get('committed'):
+            return False
+        return all(self.committed(d) for d in meta.get('depends', ()))
+
+    def commit(self, url, depends=()):
+        # depends are the urls of pages handed on from this one, it only
+        # counts as unchanged again once they are all committed too
+        meta = self.meta(url)
+        depends = sorted(depends)
+        if meta.get('digest') and (meta.get('committed') != meta['digest'] or
+                                   meta.get('depends', []) != depends):
+            meta['committed'] = meta['digest']
+            meta['depends'] = depends
+            self._save_meta(url, meta)
+
+    def evict(self, target=None):
+        if target is None:
+            target = self.max_bytes * 0.9
+
+        path = os.path.join(self.directory, 'urls')
+        metas = []
+        for name in os.listdir(path):
+            try:
+                with open(os.path.join(path, name)) as f:
+                    metas.append((json.load(f), os.path.join(path, name)))
+            except (IOError, ValueError):
+                continue
+
+        metas.sort(key=lambda m: m[0].get('used', 0))
+        live = dict((m.get('digest'), 0) for m, p in metas)
+        for meta, p in metas:
+            live[meta.get('digest')] += 1
+
+        size = sum(os.path.getsize(p) for p in self._objects())
+
+        for meta, meta_path in metas:
+            if size <= target:
+                break
+
+            os.unlink(meta_path)
+            digest = meta.get('digest')
+            live[digest] -= 1
+
+            if digest and not live[digest]:
+                obj = self._object_path(digest)
+                try:
+                    size -= os.path.getsize(obj)
+                    os.unlink(obj)
+                except OSError:
+                    pass
+
+        with self._lock:
+            self.size = size
+        LOG.info('Evicted page cache down to %s bytes', size)
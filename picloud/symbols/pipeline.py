@@ -0,0 +1,204 @@
+import copy
+import logging
+import multiprocessing
+import threading
+import time
+
+import fetcher
+import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+QUEUE_SIZE = 1000
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+class Stage(object):
+    def __init__(self, queue, handler, output_queues, workers, kind,
+                 retry_on, max_retries, retry_delay, on_failure=None):
+        self.queue = queue
+        self.handler = handler
+        self.output_queues = output_queues
+        self.workers = workers
+        self.kind = kind
+        self.retry_on = tuple(retry_on or ())
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Called with a message that is given up on after its retries
+        self.on_failure = on_failure
+        self.processed = multiprocessing.Value('L', 0)
+        self.failed = multiprocessing.Value('L', 0)
+        self._workers = []
+        # Worker processes record metrics into their own copy of the
+        # registry and hand it back when they exit
+        self._reports = None
+        if kind == PROCESS:
+            self._reports = multiprocessing.Queue()
+
+    def _count(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def _handle(self, func, msg):
+        try:
+            result = fetcher.call_with_retries(func, (msg, ),
+                                               retry_on=self.retry_on,
+                                               max_retries=self.max_retries,
+                                               retry_delay=self.retry_delay)
+        except Exception:
+            LOG.exception('%s: failed handling %r', self.queue.name, msg)
+            self._count(self.failed)
+            if self.on_failure is not None:
+                self.on_failure(msg)
+            return
+
+        self._count(self.processed)
+
+        if result is not None:
+            for output_queue in self.output_queues:
+                output_queue.push([result])
+
+    def _work(self, handler):
+        func = getattr(handler, 'message_handler', handler)
+        registry = metrics.REGISTRY
+
+        if self._reports is not None and registry is not None:
+            registry.reset()
+
+        if hasattr(handler, 'pre_handling'):
+            handler.pre_handling()
+
+        try:
+            while True:
+                msg = self.queue.get()
+                try:
+                    # None never makes it into a queue, it is the stop signal
+                    if msg is None:
+                        return
+                    self._handle(func, msg)
+                finally:
+                    self.queue.task_done()
+        finally:
+            try:
+                if hasattr(handler, 'post_handling'):
+                    handler.post_handling()
+            finally:
+                if self._reports is not None:
+                    self._reports.put(registry and registry.snapshot())
+
+    def start(self):
+        factory = threading.Thread
+        if self.kind == PROCESS:
+            factory = multiprocessing.Process
+
+        for i in range(self.workers):
+            name = '%s-%s' % (self.queue.name, i)
+            worker = factory(target=self._work, name=name,
+                             args=(copy.copy(self.handler), ))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        self.queue.join()
+
+        for worker in self._workers:
+            self.queue.put(None)
+
+        # Reports are read before joining, a process does not exit until
+        # what it put on a queue has been taken off
+        if self._reports is not None:
+            for worker in self._workers:
+                report = self._reports.get()
+                if report and metrics.REGISTRY is not None:
+                    metrics.REGISTRY.merge(report)
+
+        for worker in self._workers:
+            worker.join()
+
+
+class Queue(object):
+    def __init__(self, pipeline, name, maxsize=QUEUE_SIZE):
+        self.pipeline = pipeline
+        self.name = name
+        self._queue = multiprocessing.JoinableQueue(maxsize)
+
+    def get(self):
+        return self._queue.get()
+
+    def put(self, msg):
+        self._queue.put(msg)
+
+    def task_done(self):
+        self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def push(self, messages, delay=None):
+        # Delays only exist to be gentle on the remote side when run in the
+        # cloud, locally the bounded queue provides the backpressure
+        for msg in messages:
+            self._queue.put(msg)
+
+    def attach(self, message_handler, output_queues=None, readers_per_job=1,
+               max_parallel_jobs=1, retry_on=None, retry_delay=0,
+               max_retries=0, workers=None, kind=None, on_failure=None,
+               **kwargs):
+        if workers is None:
+            workers = self.pipeline.workers.get(self.name,
+                                                readers_per_job *
+                                                max_parallel_jobs)
+
+        if kind is None:
+            kind = self.pipeline.kinds.get(self.name, self.pipeline.kind)
+
+        stage = Stage(self, message_handler, output_queues or [], workers,
+                      kind, retry_on, max_retries, retry_delay, on_failure)
+        self.pipeline.stages.append(stage)
+        stage.start()
+        return stage
+
+
+# Runs a cloud.queue style stage graph on the local machine. Queues must be
+# attached in graph order, join() drains them in that same order so every
+# stage has finished pushing before its consumers are stopped.
+class Pipeline(object):
+    def __init__(self, maxsize=QUEUE_SIZE, workers=None, kinds=None,
+                 kind=THREAD):
+        self.maxsize = maxsize
+        self.workers = workers or {}
+        self.kinds = kinds or {}
+        self.kind = kind
+        self.queues = {}
+        self.stages = []
+        self.started = time.time()
+
+    def get(self, name):
+        if name not in self.queues:
+            self.queues[name] = Queue(self, name, self.maxsize)
+        return self.queues[name]
+
+    def join(self):
+        for stage in self.stages:
+            stage.stop()
+
+        return self.stats()
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        stats = {}
+
+        for stage in self.stages:
+            processed = stage.processed.value
+            stats[stage.queue.name] = {'processed': processed,
+                                       'failed': stage.failed.value,
+                                       'workers': stage.workers,
+                                       'kind': stage.kind,
+                                       'rate': processed / max(elapsed, 1e-6)}
+        return stats
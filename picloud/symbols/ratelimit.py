@@ -0,0 +1,172 @@
+import logging
+import multiprocessing
+import random
+import time
+import urlparse
+
+import requests
+
+import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+RATE = 2.0
+MIN_RATE = 0.1
+MAX_RATE = 50.0
+INCREASE = 0.1
+DECREASE = 0.5
+SLOW = 5.0
+COOLDOWN = 1.0
+
+BASE_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 120.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Offsets into a bucket's shared state
+_RATE, _TOKENS, _LAST, _DECREASED = range(4)
+
+
+class Bucket(object):
+    def __init__(self, rate, burst):
+        self.burst = burst
+        now = time.time()
+        self.state = multiprocessing.Array('d', [rate, burst, now, 0.0])
+
+    def take(self):
+        # Returns how long to wait before a token is available, 0 if one
+        # was taken
+        with self.state.get_lock():
+            state = self.state
+            now = time.time()
+            state[_TOKENS] = min(self.burst, state[_TOKENS] +
+                                 (now - state[_LAST]) * state[_RATE])
+            state[_LAST] = now
+
+            if state[_TOKENS] >= 1:
+                state[_TOKENS] -= 1
+                return 0
+
+            return (1 - state[_TOKENS]) / state[_RATE]
+
+    @property
+    def rate(self):
+        return self.state[_RATE]
+
+
+# Token bucket per host with AIMD adaptation: every fast, successful
+# response adds a little to the rate, an error or slow response halves it.
+# Buckets live in shared memory so every worker thread and forked process
+# draws from the same budget.
+class AdaptiveRateLimiter(object):
+    def __init__(self, hosts=None, rate=RATE, burst=None, min_rate=MIN_RATE,
+                 max_rate=MAX_RATE, increase=INCREASE, decrease=DECREASE,
+                 slow=SLOW, cooldown=COOLDOWN):
+        self.initial_rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow = slow
+        self.cooldown = cooldown
+        self.buckets = {}
+        self._lock = multiprocessing.Lock()
+
+        for host in hosts or []:
+            self.bucket(host)
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self.buckets:
+                self.buckets[host] = Bucket(self.initial_rate, self.burst)
+            return self.buckets[host]
+
+    def acquire(self, host):
+        bucket = self.bucket(host)
+        while True:
+            wait = bucket.take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def success(self, host, latency):
+        if latency > self.slow:
+            return self.failure(host)
+
+        bucket = self.bucket(host)
+        with bucket.state.get_lock():
+            bucket.state[_RATE] = min(self.max_rate,
+                                      bucket.state[_RATE] + self.increase)
+
+    def failure(self, host):
+        bucket = self.bucket(host)
+        with bucket.state.get_lock():
+            now = time.time()
+            # One decrease per cooldown, a burst of in-flight failures is
+            # a single signal
+            if now - bucket.state[_DECREASED] < self.cooldown:
+                return
+            bucket.state[_DECREASED] = now
+            bucket.state[_RATE] = max(self.min_rate,
+                                      bucket.state[_RATE] * self.decrease)
+            LOG.info('Backing off %s to %.2f requests/s', host,
+                     bucket.state[_RATE])
+
+    def rate(self, host):
+        return self.bucket(host).rate
+
+    def rates(self):
+        return dict((host, bucket.rate)
+                    for host, bucket in self.buckets.items())
+
+
+def retry_delay(attempt, base=BASE_RETRY_DELAY, maximum=MAX_RETRY_DELAY):
+    # Full jitter exponential backoff
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class RateLimitedSession(object):
+    def __init__(self, session, limiter, retry_on=None, max_retries=0,
+                 retry_status=RETRY_STATUS, base_delay=BASE_RETRY_DELAY,
+                 max_delay=MAX_RETRY_DELAY):
+        if retry_on is None:
+            retry_on = [requests.RequestException]
+
+        self.session = session
+        self.limiter = limiter
+        self.retry_on = tuple(retry_on)
+        self.max_retries = max_retries
+        self.retry_status = retry_status
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get(self, url, **kwargs):
+        host = urlparse.urlsplit(url).netloc
+        attempt = 0
+
+        while True:
+            self.limiter.acquire(host)
+            start = time.time()
+
+            try:
+                r = self.session.get(url, **kwargs)
+            except self.retry_on:
+                self.limiter.failure(host)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if r.status_code not in self.retry_status:
+                    self.limiter.success(host, time.time() - start)
+                    return r
+
+                self.limiter.failure(host)
+                if attempt >= self.max_retries:
+                    return r
+
+            metrics.inc('http_retries_total', host=host)
+            time.sleep(retry_delay(attempt, self.base_delay, self.max_delay))
+            attempt += 1
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,245 @@
+import struct
+
+
+# Tags for each value of an encoded record, strings are stored as their
+# length and appended after the fixed size values
+NONE = 'n'
+FLOAT = 'd'
+INT = 'q'
+BYTES = 's'
+TEXT = 'u'
+STRINGS = (BYTES, TEXT)
+FORMATS = {FLOAT: 'd', INT: 'q', BYTES: 'I', TEXT: 'I'}
+
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+# Records that come off a queue equal to one already decoded are shared
+# instead, up to this many per class
+INTERN_SIZE = 4096
+
+_LAYOUTS = {}
+_INTERNED = {}
+
+
+def positions(fields):
+    return dict((name, i) for i, name in enumerate(fields))
+
+
+def _layout(tags):
+    # The struct of the fixed size part and where the strings are, both
+    # among the values and among the packed values, cached per tag string
+    layout = _LAYOUTS.get(tags)
+    if layout is None:
+        packed = tags.replace(NONE, '')
+        layout = _LAYOUTS[tags] = (
+            struct.Struct('<' + ''.join(FORMATS[tag] for tag in packed)),
+            [(i, tag) for i, tag in enumerate(tags) if tag in STRINGS],
+            [(i, tag) for i, tag in enumerate(packed) if tag in STRINGS])
+    return layout
+
+
+def _tag(value):
+    if value is None:
+        return NONE
+    if isinstance(value, float):
+        return FLOAT
+    if isinstance(value, (int, long)) and INT_MIN <= value <= INT_MAX:
+        return INT
+    if isinstance(value, unicode):
+        return TEXT
+    if isinstance(value, str):
+        return BYTES
+    raise TypeError('Can not encode %r' % (value, ))
+
+
+_TAGS = {type(None): NONE, float: FLOAT, int: INT, str: BYTES,
+         unicode: TEXT}
+
+
+def encode(values):
+    # Exact types are looked up, anything else (longs, subclasses) is
+    # checked one by one
+    try:
+        tags = ''.join([_TAGS[type(value)] for value in values])
+    except KeyError:
+        tags = ''.join([_tag(value) for value in values])
+
+    s, unused, packed_strings = _layout(tags)
+    fixed = [value for value in values if value is not None]
+
+    strings = []
+    for i, tag in packed_strings:
+        value = fixed[i]
+        if tag == TEXT:
+            value = value.encode('utf-8')
+        strings.append(value)
+        fixed[i] = len(value)
+
+    return tags + s.pack(*fixed) + ''.join(strings)
+
+
+def decode(data, count):
+    tags = data[:count]
+    s, strings, unused = _layout(tags)
+    fixed = iter(s.unpack_from(data, count)).next
+    values = [None if tag == NONE else fixed() for tag in tags]
+
+    offset = count + s.size
+    for i, tag in strings:
+        end = offset + values[i]
+        value = data[offset:end]
+        offset = end
+        values[i] = value.decode('utf-8') if tag == TEXT else value
+
+    return values
+
+
+def _decode(cls, data):
+    if not cls.INTERN:
+        return cls(decode(data, len(cls.FIELDS)))
+
+    interned = _INTERNED.setdefault(cls, {})
+    record = interned.get(data)
+    if record is None:
+        if len(interned) >= INTERN_SIZE:
+            interned.clear()
+        record = interned[data] = cls(decode(data, len(cls.FIELDS)))
+    return record
+
+
+# A fixed schema row. Subclasses set FIELDS and POSITIONS (see positions)
+# and the values are kept in one list in that order, so a record costs a
+# list of pointers instead of a dict keyed by field name. Reads as a
+# mapping of the fields that are set, and pickles as its encode() bytes.
+class Record(object):
+    __slots__ = ('values', )
+
+    FIELDS = ()
+    POSITIONS = {}
+    INTERN = False
+
+    def __init__(self, values=None):
+        if values is None:
+            values = [None] * len(self.FIELDS)
+        self.values = values
+
+    @classmethod
+    def from_items(cls, items, positions=None):
+        # positions maps other names, e.g. page labels, onto fields
+        if positions is None:
+            positions = cls.POSITIONS
+
+        record = cls()
+        for name, value in items:
+            i = positions.get(name)
+            if i is not None:
+                record.values[i] = value
+        return record
+
+    def __getitem__(self, name):
+        return self.values[self.POSITIONS[name]]
+
+    def __setitem__(self, name, value):
+        self.values[self.POSITIONS[name]] = value
+
+    def get(self, name, default=None):
+        i = self.POSITIONS.get(name)
+        if i is None or self.values[i] is None:
+            return default
+        return self.values[i]
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not None)
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.values == other.values)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+    def iteritems(self):
+        for name, value in zip(self.FIELDS, self.values):
+            if value is not None:
+                yield name, value
+
+    def asdict(self):
+        # Every field, unset ones as None, the way MySQLdb wants a row
+        return dict(zip(self.FIELDS, self.values))
+
+    def encode(self):
+        return encode(self.values)
+
+    @classmethod
+    def decode(cls, data):
+        return _decode(cls, data)
+
+    def __reduce__(self):
+        return _decode, (self.__class__, self.encode())
+
+
+# One ticker scraped off an industry page. The sector and industry stats
+# are a record shared by every ticker of the industry and the keystats
+# are added once fetched. Reads as a mapping of the ticker and the stats,
+# the way the queue handlers and url templates use it.
+class Ticker(object):
+    __slots__ = ('ticker', 'industry_id', 'ticker_id', 'stats', 'keystats')
+
+    def __init__(self, ticker, industry_id, stats, ticker_id=None,
+                 keystats=None):
+        self.ticker = ticker
+        self.industry_id = industry_id
+        self.stats = stats
+        self.ticker_id = ticker_id
+        self.keystats = keystats
+
+    def __getitem__(self, name):
+        if name in self.__slots__:
+            return getattr(self, name)
+        return self.stats[name]
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        try:
+            value = self[name]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, name) == getattr(other, name)
+                    for name in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Ticker(%r)' % self.ticker
+
+    def asdict(self):
+        row = self.stats.asdict()
+        row.update(ticker=self.ticker,
+                   industry_id=self.industry_id,
+                   ticker_id=self.ticker_id)
+        return row
+
+    def __reduce__(self):
+        # Pickle keeps one copy of stats per message however many tickers
+        # share it
+        return Ticker, (self.ticker, self.industry_id, self.stats,
+                        self.ticker_id, self.keystats)
@@ -0,0 +1,373 @@
+import contextlib
+import cPickle as pickle
+import hashlib
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+SHARDS = 64
+# Seconds without a heartbeat, or without finishing anything it holds,
+# before a worker's shards are handed to the others
+STALL = 300
+POLL = 1
+BATCH = 100
+TIMEOUT = 60
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+# Keys per statement, sqlite allows 999 parameters
+CHUNK = 500
+
+SCHEMA = ("""
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT)
+""", """
+CREATE TABLE IF NOT EXISTS shards (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT)
+""", """
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    heartbeat REAL,
+    progress REAL,
+    evicted INTEGER DEFAULT 0)
+""", """
+CREATE TABLE IF NOT EXISTS work (
+    kind TEXT,
+    key TEXT,
+    shard INTEGER,
+    state TEXT,
+    owner TEXT,
+    attempts INTEGER DEFAULT 0,
+    payload BLOB,
+    PRIMARY KEY (kind, key))
+""", """
+CREATE INDEX IF NOT EXISTS work_shard ON work (kind, state, shard)
+""", """
+CREATE INDEX IF NOT EXISTS work_owner ON work (owner, state)
+""")
+
+
+def shard_of(key, shards):
+    # Stable across processes and machines, unlike hash()
+    return int(hashlib.md5(str(key)).hexdigest()[:8], 16) % shards
+
+
+def default_worker():
+    return '%s-%s' % (socket.gethostname(), os.getpid())
+
+
+def _chunks(keys):
+    keys = list(keys)
+    for i in xrange(0, len(keys), CHUNK):
+        yield keys[i:i + CHUNK]
+
+
+# Work items and shard ownership for a sharded crawl, kept in one sqlite
+# file every worker opens. Items are hashed into a fixed number of shards
+# and a worker only claims pending items from shards it owns, so nothing
+# is fetched twice unless its owner stalls. Use a new file for every crawl.
+class WorkStore(object):
+    def __init__(self, path, shards=SHARDS, worker=None, stall=STALL,
+                 timeout=TIMEOUT):
+        self.path = path
+        self.worker = worker or default_worker()
+        self.stall = stall
+        self.timeout = timeout
+        self._local = threading.local()
+
+        with self.transaction() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+            db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                       ('shards', str(shards)))
+            self.shards = int(db.execute(
+                "SELECT value FROM meta WHERE name = 'shards'").fetchone()[0])
+            db.executemany('INSERT OR IGNORE INTO shards VALUES (?, NULL)',
+                           [(shard, ) for shard in xrange(self.shards)])
+
+        if self.shards != shards:
+            LOG.warning('%s was created with %s shards, not %s', path,
+                        self.shards, shards)
+
+    def _db(self):
+        # One connection per thread, and a new one after a fork
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def add(self, kind, items):
+        # items are (key, message), keys already in the store are left
+        # alone whatever their state
+        rows = [(kind, str(key), shard_of(key, self.shards), PENDING,
+                 sqlite3.Binary(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)))
+                for key, msg in items]
+        with self.transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO work '
+                           '(kind, key, shard, state, payload) '
+                           'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def seed(self, kind, items):
+        self.add(kind, items)
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', '1')")
+
+    def seeded(self):
+        return self._db().execute(
+            "SELECT 1 FROM meta WHERE name = 'seeded'").fetchone() is not None
+
+    def heartbeat(self):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO workers VALUES (?, ?, ?, 0)',
+                       (self.worker, now, now))
+            db.execute('UPDATE workers SET heartbeat = ? WHERE name = ?',
+                       (now, self.worker))
+
+    def live_workers(self, db, now=None):
+        if now is None:
+            now = time.time()
+        return [name for name, in db.execute(
+            'SELECT name FROM workers WHERE heartbeat > ? AND evicted = 0',
+            (now - self.stall, ))]
+
+    def acquire(self):
+        # Takes unowned shards up to a fair share of them and returns the
+        # shards this worker owns. An evicted worker gets none until it
+        # finishes something again
+        with self.transaction() as db:
+            evicted = db.execute('SELECT evicted FROM workers WHERE name = ?',
+                                 (self.worker, )).fetchone()
+            if evicted and evicted[0]:
+                return []
+
+            live = max(len(self.live_workers(db)), 1)
+            fair = int(math.ceil(self.shards / float(live)))
+            owned = db.execute('SELECT COUNT(*) FROM shards WHERE owner = ?',
+                               (self.worker, )).fetchone()[0]
+            if owned < fair:
+                db.execute('UPDATE shards SET owner = ? WHERE shard IN '
+                           '(SELECT shard FROM shards WHERE owner IS NULL '
+                           'LIMIT ?)', (self.worker, fair - owned))
+            return [shard for shard, in db.execute(
+                'SELECT shard FROM shards WHERE owner = ?', (self.worker, ))]
+
+    def claim(self, kind, limit=BATCH):
+        with self.transaction() as db:
+            rows = db.execute('SELECT w.key, w.payload FROM work w '
+                              'JOIN shards s ON s.shard = w.shard '
+                              'WHERE s.owner = ? AND w.kind = ? '
+                              'AND w.state = ? LIMIT ?',
+                              (self.worker, kind, PENDING, limit)).fetchall()
+            self._set(db, kind, [key for key, payload in rows], CLAIMED,
+                      ', owner = ?, attempts = attempts + 1', (self.worker, ))
+        return [(key, pickle.loads(str(payload))) for key, payload in rows]
+
+    def _set(self, db, kind, keys, state, extra='', params=()):
+        for chunk in _chunks(keys):
+            db.execute('UPDATE work SET state = ?%s WHERE kind = ? '
+                       'AND key IN (%s)' % (extra,
+                                            ', '.join(['?'] * len(chunk))),
+                       (state, ) + tuple(params) + (kind, ) + tuple(chunk))
+
+    def done(self, kind, keys, state=DONE):
+        keys = [str(key) for key in keys]
+        if not keys:
+            return
+        with self.transaction() as db:
+            self._set(db, kind, keys, state)
+            db.execute('UPDATE workers SET progress = ?, evicted = 0 '
+                       'WHERE name = ?', (time.time(), self.worker))
+
+    def fail(self, kind, keys):
+        self.done(kind, keys, FAILED)
+
+    def release(self, worker=None, db=None, evict=False):
+        # Gives up a worker's shards and puts what it claimed but did not
+        # finish back to pending. An evicted worker stays known so it can
+        # not take shards back while it is stuck
+        if worker is None:
+            worker = self.worker
+        if db is None:
+            with self.transaction() as db:
+                return self.release(worker, db, evict)
+
+        db.execute('UPDATE shards SET owner = NULL WHERE owner = ?',
+                   (worker, ))
+        db.execute('UPDATE work SET state = ?, owner = NULL '
+                   'WHERE owner = ? AND state = ?',
+                   (PENDING, worker, CLAIMED))
+        if evict:
+            db.execute('UPDATE workers SET evicted = 1 WHERE name = ?',
+                       (worker, ))
+        else:
+            db.execute('DELETE FROM workers WHERE name = ?', (worker, ))
+
+    def outstanding(self, producing=(), others=()):
+        # Pending items, plus claimed items of the kinds whose handling
+        # adds more work, plus those of others claimed by other workers
+        db = self._db()
+        count = db.execute('SELECT COUNT(*) FROM work WHERE state = ?',
+                           (PENDING, )).fetchone()[0]
+        for kind in producing:
+            count += db.execute('SELECT COUNT(*) FROM work '
+                                'WHERE kind = ? AND state = ?',
+                                (kind, CLAIMED)).fetchone()[0]
+        for kind in others:
+            count += db.execute('SELECT COUNT(*) FROM work '
+                                'WHERE kind = ? AND state = ? '
+                                'AND owner != ?',
+                                (kind, CLAIMED, self.worker)).fetchone()[0]
+        return count
+
+    def counts(self):
+        counts = {}
+        for kind, state, count in self._db().execute(
+                'SELECT kind, state, COUNT(*) FROM work '
+                'GROUP BY kind, state'):
+            counts.setdefault(kind, {})[state] = count
+        return counts
+
+
+# Hands the shards of stalled workers to the others, and takes shards off
+# workers holding more than their share so newcomers get some
+class Coordinator(object):
+    def __init__(self, store, interval=POLL * 10):
+        self.store = store
+        self.interval = interval
+
+    def rebalance(self):
+        now = time.time()
+        stall = self.store.stall
+
+        with self.store.transaction() as db:
+            for name, heartbeat, progress in db.execute(
+                    'SELECT name, heartbeat, progress FROM workers '
+                    'WHERE evicted = 0').fetchall():
+                if now - heartbeat > stall:
+                    LOG.warning('Worker %s is gone, releasing its shards',
+                                name)
+                    self.store.release(name, db)
+
+                elif now - progress > stall and db.execute(
+                        'SELECT COUNT(*) FROM work WHERE owner = ? '
+                        'AND state = ?', (name, CLAIMED)).fetchone()[0]:
+                    LOG.warning('Worker %s stalled, releasing its shards',
+                                name)
+                    self.store.release(name, db, evict=True)
+
+            live = self.store.live_workers(db, now)
+            if not live:
+                return
+
+            fair = int(math.ceil(self.store.shards / float(len(live))))
+            for name in live:
+                owned = db.execute('SELECT COUNT(*) FROM shards '
+                                   'WHERE owner = ?', (name, )).fetchone()[0]
+                if owned > fair:
+                    db.execute('UPDATE shards SET owner = NULL WHERE shard IN '
+                               '(SELECT shard FROM shards WHERE owner = ? '
+                               'LIMIT ?)', (name, owned - fair))
+
+    def run(self, stop):
+        while not stop.is_set():
+            try:
+                self.rebalance()
+            except sqlite3.Error:
+                LOG.exception('Rebalancing shards failed')
+            stop.wait(self.interval)
+
+    def start(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, args=(self._stop, ),
+                                        name='shard-coordinator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        # Waits for a rebalance in progress, the store must not be released
+        # or closed under it
+        self._stop.set()
+        self._thread.join()
+
+
+# Stands in for a queue whose messages are handed to the store instead,
+# to be claimed by the owner of their shard
+class StoreQueue(object):
+    def __init__(self, store, kind, key):
+        self.store = store
+        self.kind = kind
+        self.key = key
+        self.name = 'store-%s' % kind
+
+    def push(self, messages, delay=None):
+        self.store.add(self.kind, [(self.key(msg), msg) for msg in messages])
+
+
+# Moves pending work of the shards this worker owns into its local queues,
+# topping each up to batch messages, until the crawl has nothing left (see
+# WorkStore.outstanding). The coordinator also waits on the other workers,
+# so it can take over whatever they stall on.
+class Feeder(object):
+    def __init__(self, store, queues, producing=(), others=(), batch=BATCH,
+                 poll=POLL):
+        self.store = store
+        self.queues = queues
+        self.producing = producing
+        self.others = others
+        self.batch = batch
+        self.poll = poll
+
+    def feed(self):
+        fed = 0
+        for kind, queue in self.queues:
+            room = self.batch - queue.qsize()
+            if room <= 0:
+                continue
+            items = self.store.claim(kind, room)
+            if items:
+                queue.push([msg for key, msg in items])
+                fed += len(items)
+        return fed
+
+    def run(self):
+        while True:
+            self.store.heartbeat()
+            self.store.acquire()
+
+            if self.feed():
+                continue
+
+            if self.store.seeded() and not self.store.outstanding(
+                    self.producing, self.others):
+                return
+
+            time.sleep(self.poll)
@@ -0,0 +1,340 @@
+import cStringIO
+import datetime
+import logging
+import sqlite3
+import tempfile
+
+import MySQLdb
+import pandas as pd
+
+import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+MYSQL = 'mysql'
+SQLITE = 'sqlite'
+ENGINES = (MYSQL, SQLITE)
+
+# Rows from which MySQLStorage.insert loads a batch with LOAD DATA instead
+# of a multi-row INSERT
+BULK_ROWS = 500
+TIMEOUT = 60
+
+
+def _date(value):
+    # DATE columns are handed datetimes too, MySQL drops the time and so
+    # does this
+    return datetime.date(*map(int, value[:10].split('-')))
+
+
+sqlite3.register_converter('DATE', _date)
+
+
+def _quote(columns):
+    return ', '.join(['`%s`' % c for c in columns])
+
+
+def _field(value):
+    # A value as LOAD DATA reads it with the default tab separated format
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        return str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+# Where the fetcher writes tickers and keystats and the screens read them.
+# An instance only holds what it needs to connect and pickles as that, the
+# handlers call connect() for a connected copy of their own. Rows are
+# dicts keyed by column, as MySQLdb takes them.
+class Storage(object):
+    engine = None
+    placeholder = '%s'
+    # Column definitions of an id set when the row is inserted, the
+    # table's primary key, and of the time it was inserted
+    serial = 'INT NOT NULL AUTO_INCREMENT'
+    timestamp = 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.db = None
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def connect(self):
+        storage = self.__class__(**self.kwargs)
+        storage.db = storage._connect()
+        return storage
+
+    def close(self):
+        self.db.close()
+        self.db = None
+
+    def commit(self):
+        self.db.commit()
+
+    def execute(self, sql, params=()):
+        cursor = self.db.cursor()
+        cursor.execute(sql, params)
+        cursor.close()
+
+    def executemany(self, sql, rows):
+        cursor = self.db.cursor()
+        cursor.executemany(sql, rows)
+        cursor.close()
+
+    def query(self, sql, params=()):
+        cursor = self.db.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def params(self, count):
+        return ', '.join([self.placeholder] * count)
+
+    def named(self, columns):
+        return ', '.join(['%%(%s)s' % c for c in columns])
+
+    def now(self):
+        return 'NOW()'
+
+    def typed(self, expr, name, definition):
+        # A computed column, e.g. MAX() of a date, that comes back as the
+        # type a stored one would
+        return '%s AS `%s`' % (expr, name)
+
+    def recent(self, column, days):
+        # column is within the last days days
+        return '%s BETWEEN DATE_SUB(NOW(), INTERVAL %d DAY) AND NOW()' % (
+            column, days)
+
+    def read_frame(self, sql, params=(), **kwargs):
+        db = self.db or self._connect()
+        try:
+            return pd.read_sql(sql, db, params=params, **kwargs)
+        finally:
+            if db is not self.db:
+                db.close()
+
+    def has_table(self, table):
+        raise NotImplementedError
+
+    def has_column(self, table, column):
+        raise NotImplementedError
+
+    def create_table(self, table, columns, primary=(), unique=(), keys=()):
+        # columns are (name, definition), keys a list of column tuples
+        raise NotImplementedError
+
+    def create_table_as(self, table, columns, select, primary=(), keys=()):
+        # A table of select's rows, duplicate primary keys dropped. The
+        # column types are taken from select where the engine can
+        raise NotImplementedError
+
+    def add_column(self, table, column, definition, key=False):
+        raise NotImplementedError
+
+    def insert(self, table, columns, rows):
+        self.executemany('INSERT INTO %s (%s) VALUES (%s)' %
+                         (table, _quote(columns), self.named(columns)),
+                         rows)
+
+    def upsert(self, table, keys, columns, rows, touch=None):
+        # Inserts rows, or updates columns of those already stored under
+        # keys. touch is a column set to now() on update.
+        raise NotImplementedError
+
+
+class MySQLStorage(Storage):
+    engine = MYSQL
+
+    # kwargs are passed to MySQLdb.connect as they are
+    def __init__(self, bulk_rows=BULK_ROWS, **kwargs):
+        Storage.__init__(self, bulk_rows=bulk_rows, **kwargs)
+        self.bulk_rows = bulk_rows
+
+    def _connect(self):
+        kwargs = dict(self.kwargs)
+        kwargs.pop('bulk_rows')
+        if self.bulk_rows:
+            kwargs.setdefault('local_infile', 1)
+        return MySQLdb.connect(**kwargs)
+
+    def has_table(self, table):
+        return bool(self.query('SHOW TABLES LIKE %s', (table, )))
+
+    def has_column(self, table, column):
+        return bool(self.query('SHOW COLUMNS FROM %s LIKE %%s' % table,
+                               (column, )))
+
+    def _keys(self, primary, unique, keys):
+        clauses = []
+        if primary:
+            clauses.append('PRIMARY KEY (%s)' % _quote(primary))
+        if unique:
+            clauses.append('UNIQUE KEY (%s)' % _quote(unique))
+        clauses.extend('KEY (%s)' % _quote(key) for key in keys)
+        return clauses
+
+    def create_table(self, table, columns, primary=(), unique=(), keys=()):
+        self.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+            table, ', '.join(['`%s` %s' % column for column in columns] +
+                             self._keys(primary, unique, keys))))
+
+    def create_table_as(self, table, columns, select, primary=(), keys=()):
+        self.execute('CREATE TABLE IF NOT EXISTS %s (%s) IGNORE %s' % (
+            table, ', '.join(self._keys(primary, (), keys)), select))
+
+    def add_column(self, table, column, definition, key=False):
+        sql = 'ALTER TABLE %s ADD COLUMN `%s` %s' % (table, column,
+                                                     definition)
+        if key:
+            sql += ', ADD KEY (`%s`)' % column
+        self.execute(sql)
+
+    def insert(self, table, columns, rows):
+        if self.bulk_rows and len(rows) >= self.bulk_rows:
+            try:
+                return self.load(table, columns, rows)
+            except MySQLdb.DatabaseError as e:
+                LOG.warning('LOAD DATA into %s failed (%s), inserting '
+                            'instead from now on', table, e)
+                self.bulk_rows = 0
+        Storage.insert(self, table, columns, rows)
+
+    def load(self, table, columns, rows):
+        # The client library only loads from a file, the rows are written
+        # out in one go from memory
+        buf = cStringIO.StringIO()
+        for row in rows:
+            buf.write('\t'.join([_field(row.get(c)) for c in columns]))
+            buf.write('\n')
+
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as f:
+            f.write(buf.getvalue())
+            f.flush()
+            self.execute('LOAD DATA LOCAL INFILE %%s INTO TABLE %s '
+                         'CHARACTER SET utf8 (%s)' % (table,
+                                                      _quote(columns)),
+                         (f.name, ))
+        metrics.inc('db_bulk_rows_total', len(rows), table=table)
+
+    def upsert(self, table, keys, columns, rows, touch=None):
+        # executemany still sends this as a single multi-row INSERT, the
+        # VALUES() in the update are the only nested parens it allows
+        updates = ['`%s` = VALUES(`%s`)' % (c, c) for c in columns
+                   if c not in keys]
+        if touch:
+            updates.insert(0, '`%s` = NOW()' % touch)
+        self.executemany(' '.join([
+            'INSERT INTO %s (%s)' % (table, _quote(columns)),
+            'VALUES (%s)' % self.named(columns),
+            'ON DUPLICATE KEY UPDATE %s' % ', '.join(updates)]), rows)
+
+
+# A single file database for local runs and trying things out, no server
+# needed. Dates and times come back as python objects, like from MySQL.
+class SQLiteStorage(Storage):
+    engine = SQLITE
+    placeholder = '?'
+    serial = 'INTEGER'
+    timestamp = "TIMESTAMP DEFAULT (datetime('now', 'localtime'))"
+
+    def __init__(self, path, timeout=TIMEOUT):
+        Storage.__init__(self, path=path, timeout=timeout)
+        self.path = path
+        self.timeout = timeout
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout,
+                             detect_types=(sqlite3.PARSE_DECLTYPES |
+                                           sqlite3.PARSE_COLNAMES),
+                             isolation_level='IMMEDIATE')
+        db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    def named(self, columns):
+        return ', '.join([':%s' % c for c in columns])
+
+    def now(self):
+        return "datetime('now', 'localtime')"
+
+    def typed(self, expr, name, definition):
+        return '%s AS "%s [%s]"' % (expr, name, definition)
+
+    def recent(self, column, days):
+        # Times written from python carry microseconds, now() does not
+        return ("datetime(%s) BETWEEN datetime('now', 'localtime', "
+                "'-%d days') AND datetime('now', 'localtime')" %
+                (column, days))
+
+    def has_table(self, table):
+        return bool(self.query("SELECT 1 FROM sqlite_master "
+                               "WHERE type = 'table' AND name = ?",
+                               (table, )))
+
+    def has_column(self, table, column):
+        return any(row[1] == column
+                   for row in self.query('PRAGMA table_info(%s)' % table))
+
+    def _indexes(self, table, unique, keys):
+        if unique:
+            self.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                         % (table, '_'.join(unique), table, _quote(unique)))
+        for key in keys:
+            self.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' %
+                         (table, '_'.join(key), table, _quote(key)))
+
+    def create_table(self, table, columns, primary=(), unique=(), keys=()):
+        definitions = ['`%s` %s' % column for column in columns]
+        if primary:
+            definitions.append('PRIMARY KEY (%s)' % _quote(primary))
+        self.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %
+                     (table, ', '.join(definitions)))
+        self._indexes(table, unique, keys)
+
+    def create_table_as(self, table, columns, select, primary=(), keys=()):
+        # A CREATE TABLE AS would lose the declared types, and with them
+        # the conversion of dates
+        self.create_table(table, columns, primary=primary, keys=keys)
+        self.execute('INSERT OR IGNORE INTO %s %s' % (table, select))
+
+    def add_column(self, table, column, definition, key=False):
+        self.execute('ALTER TABLE %s ADD COLUMN `%s` %s' %
+                     (table, column, definition))
+        if key:
+            self._indexes(table, (), [(column, )])
+
+    def upsert(self, table, keys, columns, rows, touch=None):
+        # Update what is there and insert the rest, a REPLACE would drop
+        # the columns not given, like the tickers' ids
+        updates = ['`%s` = :%s' % (c, c) for c in columns if c not in keys]
+        if touch:
+            updates.insert(0, '`%s` = %s' % (touch, self.now()))
+        self.executemany('UPDATE %s SET %s WHERE %s' % (
+            table, ', '.join(updates),
+            ' AND '.join(['`%s` = :%s' % (k, k) for k in keys])), rows)
+        self.executemany('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' %
+                         (table, _quote(columns), self.named(columns)),
+                         rows)
+
+
+def backend(engine, database, host=None, user=None, password=None,
+            bulk_rows=BULK_ROWS):
+    # For sqlite database is the path of the file
+    if engine == SQLITE:
+        return SQLiteStorage(database)
+    return MySQLStorage(host=host, user=user, passwd=password, db=database,
+                        bulk_rows=bulk_rows)
@@ -0,0 +1,94 @@
+import datetime
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'magicformula'))
+
+import backtest  # noqa
+import predict  # noqa
+import ranking  # noqa
+
+
+SECTORS = ('Technology', 'Financial', 'Healthcare', 'Utilities')
+
+
+def make_panel(tickers=60, days=45, seed=0):
+    # Refreshes at random times of day, some tickers skipping days and
+    # some refreshed twice in a day
+    rnd = np.random.RandomState(seed)
+    start = pd.Timestamp('2014-01-01')
+    rows = []
+    for i in xrange(tickers):
+        for day in xrange(days):
+            for refresh in xrange(rnd.choice([0, 1, 1, 1, 2])):
+                rows.append({
+                    'ticker': 'T%d' % i,
+                    'date': start + pd.Timedelta(days=day,
+                                                 seconds=rnd.randint(86400)),
+                    'sector': SECTORS[i % len(SECTORS)],
+                    'industry': 'Industry %d' % (i % 7),
+                    'roa_ttm': rnd.uniform(0, 1),
+                    'trailing_pe': rnd.uniform(0, 40),
+                    'market_cap': rnd.uniform(1e7, 1e9)})
+    return pd.DataFrame(rows)
+
+
+# The screen run date by date on the latest row of every ticker in
+# (date - max_age, date]
+def naive_select(panel, dates, num, max_age=backtest.MAX_AGE):
+    panel = panel.sort_values('date', kind='mergesort')
+    selected = []
+    for date in dates:
+        window = panel[(panel['date'] > date - max_age) &
+                       (panel['date'] <= date)]
+        latest = window.drop_duplicates('ticker', keep='last')
+        screened = predict.SCREEN.apply(latest)
+        ranked = ranking.rank_frame(screened, predict.RANKS, num)
+        selected.append(sorted(ranked['ticker']))
+    return selected
+
+
+class PeriodsTest(unittest.TestCase):
+    def check(self, freq, num=10):
+        panel = make_panel()
+        dates = pd.date_range('2014-01-08', '2014-02-14', freq=freq)
+        engine = backtest.Backtest(predict.SCREEN, predict.RANKS, num,
+                                   processes=1, chunk_size=5)
+
+        holdings = engine.select(panel, dates)
+        got = [sorted(holdings['ticker'][holdings['period'] == i])
+               for i in xrange(len(dates))]
+
+        self.assertEqual(got, naive_select(panel, dates, num))
+
+    def test_weekly(self):
+        self.check('W-FRI')
+
+    def test_daily(self):
+        self.check('D')
+
+    def test_business_days(self):
+        self.check('B')
+
+    def test_max_age(self):
+        panel = pd.DataFrame({'ticker': ['A', 'A', 'B'],
+                              'date': pd.to_datetime(['2014-01-01',
+                                                      '2014-01-03',
+                                                      '2014-01-02'])})
+        dates = pd.date_range('2014-01-01', '2014-01-12', freq='D')
+        engine = backtest.Backtest(None, (), max_age=datetime.timedelta(7))
+
+        periods = engine.periods(panel, dates)
+        days = dict((ticker, [dates[p].day for p in group['period']])
+                    for ticker, group in periods.groupby('ticker'))
+
+        self.assertEqual(days, {'A': range(1, 10), 'B': range(2, 9)})
+
+
+if __name__ == '__main__':
+    unittest.main()
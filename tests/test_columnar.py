@@ -0,0 +1,114 @@
+import math
+import os
+import random
+import sys
+import unittest
+
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'picloud', 'symbols'))
+
+import columnar  # noqa
+import fetch  # noqa
+
+
+# Where float() and a hand rolled parser part ways
+EDGES = ('inf', '-inf', 'Infinity', '+INFINITY', 'nan', 'NaN%', 'inf%',
+         'infB', '-infM', 'nanK', '1e400', '-1e400', '1e400%', '1e300B',
+         '1e-400', '123456789.123456789', '0.1', '1.', '.5', '1.e5', '.e5',
+         '-.e5', '1e5.5', '1e5.',
+         ' 1,234.5 ', '1,234B', '5%B', '5%%', '%', 'B', '1_000', '0x10',
+         '1e', '1e+', 'e5', '-e5', '+-1', '1-', '-', '.', '1.2.3', '1e5e5',
+         u'\u0661\u0662', u'\u0661\u0662%')
+
+# Plain looking but not a float, one of these sends every value through
+# float() on its own
+RAISES = (u'1\x0025', )
+
+
+def random_value(rnd):
+    kind = rnd.random()
+
+    if kind < 0.05:
+        return rnd.choice((None, '', 'N/A', 'n/a', 'NaN', 'na', 'NA', '-',
+                           'Dec 31, 2013', 'Sep 30', '2:1', ' ', 'B', '%'))
+
+    number = rnd.choice(('%d' % rnd.randint(-10 ** 6, 10 ** 6),
+                         '%.2f' % rnd.uniform(-1000, 1000),
+                         '{:,}'.format(rnd.randint(0, 10 ** 9)),
+                         '{:,.2f}'.format(rnd.uniform(-10 ** 7, 10 ** 7)),
+                         '%.3e' % rnd.uniform(-10 ** 6, 10 ** 6),
+                         repr(rnd.uniform(-10 ** 6, 10 ** 6))))
+
+    if kind < 0.35:
+        number += rnd.choice('BbMmKk')
+    elif kind < 0.6:
+        number += '%'
+
+    if rnd.random() < 0.05:
+        number = rnd.choice((' ', '')) + number + rnd.choice((' ', '\n'))
+
+    return number
+
+
+def expected(value):
+    try:
+        value = fetch.numify(value)
+    except (ValueError, OverflowError):
+        # numify raises on garbage in front of a suffix and on a suffixed
+        # inf or NaN, the column has NaN
+        return float('nan')
+
+    if value is None:
+        return float('nan')
+
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+# The column version agrees with numify on every value
+class NumifyColumnTest(unittest.TestCase):
+    def check(self, values):
+        column = columnar.numify_column(values)
+
+        self.assertEqual(len(column), len(values))
+        for value, got in zip(values, column):
+            want = expected(value)
+            if not (math.isnan(want) and math.isnan(got)):
+                self.assertEqual(want, got, '%r: numify gives %r, column '
+                                            'gives %r' % (value, want, got))
+
+    def random_values(self, number=20000, seed=0):
+        rnd = random.Random(seed)
+        return [random_value(rnd) for i in xrange(number)]
+
+    def test_edges(self):
+        self.check(list(EDGES))
+
+    def test_random(self):
+        for seed in range(5):
+            self.check(self.random_values(seed=seed))
+
+    def test_raises(self):
+        for value in RAISES:
+            self.check(list(EDGES) + self.random_values(2000) + [value])
+
+    def test_empty(self):
+        self.check([])
+        self.check([None, None])
+
+    def test_series(self):
+        values = pd.Series(['1.5B', 'N/A', '3%'], index=[3, 1, 2],
+                           name='market_cap')
+        column = columnar.numify_column(values)
+
+        self.assertEqual(list(column.index), [3, 1, 2])
+        self.assertEqual(column.name, 'market_cap')
+        self.assertEqual(column[3], 1500000000.0)
+
+
+if __name__ == '__main__':
+    unittest.main()